@@ -0,0 +1,174 @@
+import os, csv, json, hashlib
+from collections import OrderedDict
+from datetime import datetime
+
+from publishing import upsert_records, upload_file, slugify, ensure_directory
+
+# Per-contest aggregates (leader, runner-up, margin, turnout, precincts
+# reporting) are computed here once per changed cycle so that consumers
+# don't have to derive them from the raw summary rows with datastore
+# queries on every page view.
+
+aggregate_fields = [
+    {'id': 'contest_name', 'type': 'text'},
+    {'id': 'leader', 'type': 'text'},
+    {'id': 'leader_party', 'type': 'text'},
+    {'id': 'leader_votes', 'type': 'int'},
+    {'id': 'runner_up', 'type': 'text'},
+    {'id': 'runner_up_votes', 'type': 'int'},
+    {'id': 'margin', 'type': 'int'},
+    {'id': 'margin_percent', 'type': 'float'},
+    {'id': 'total_votes', 'type': 'int'},
+    {'id': 'registered_voters', 'type': 'int'},
+    {'id': 'ballots_cast', 'type': 'int'},
+    {'id': 'turnout', 'type': 'float'},
+    {'id': 'number_of_precincts_reporting', 'type': 'int'},
+    {'id': 'total_number_of_precincts', 'type': 'int'},
+    {'id': 'percent_of_precincts_reporting', 'type': 'float'},
+    {'id': 'updated_at', 'type': 'timestamp'},
+]
+
+def normalize_header(header):
+    # 'num Precinct rptg' => 'num_precinct_rptg'
+    return header.strip().lower().replace(' ', '_')
+
+def load_summary_rows(schema, target, encoding='utf-8'):
+    # Run the rows of summary.csv through the same schema that the
+    # pipeline uses, so that everything derived from them is based on
+    # validated values.
+    loader = schema()
+    rows = []
+    with open(target, 'r', encoding=encoding, newline='') as f:
+        reader = csv.DictReader(f)
+        for k, raw_row in enumerate(reader):
+            row = {normalize_header(key): (value if value != '' else None) for key, value in raw_row.items() if key is not None}
+            data, errors = loader.load(row)
+            if errors:
+                raise ValueError("Row {} of {} failed validation: {}".format(k + 1, target, errors))
+            rows.append(data)
+    return rows
+
+def group_by_contest(rows):
+    contests = OrderedDict()
+    for row in sorted(rows, key=lambda r: r['line_number']):
+        contests.setdefault(row['contest_name'], []).append(row)
+    return contests
+
+def contest_digest(contest_rows):
+    hasher = hashlib.md5()
+    hasher.update(json.dumps(contest_rows, sort_keys=True, default=str).encode('utf-8'))
+    return hasher.hexdigest()
+
+def first_value(contest_rows, field):
+    for row in contest_rows:
+        if row.get(field) is not None:
+            return row[field]
+    return None
+
+def compute_contest_aggregate(contest_name, contest_rows):
+    ranked = sorted(contest_rows, key=lambda r: (-(r['total_votes'] or 0), r['line_number']))
+    leader = ranked[0]
+    runner_up = ranked[1] if len(ranked) > 1 else None
+    total_votes = sum(r['total_votes'] or 0 for r in contest_rows)
+
+    leader_votes = leader['total_votes'] or 0
+    runner_up_votes = (runner_up['total_votes'] or 0) if runner_up is not None else 0
+    margin = leader_votes - runner_up_votes
+    margin_percent = round(100.0 * margin / total_votes, 2) if total_votes > 0 else None
+
+    registered_voters = first_value(contest_rows, 'registered_voters')
+    ballots_cast = first_value(contest_rows, 'ballots_cast')
+    turnout = None
+    if registered_voters and ballots_cast is not None:
+        turnout = round(100.0 * ballots_cast / registered_voters, 2)
+
+    precincts_reporting = first_value(contest_rows, 'num_precinct_rptg')
+    precincts_total = first_value(contest_rows, 'num_precinct_total')
+    percent_reporting = None
+    if precincts_total and precincts_reporting is not None:
+        percent_reporting = round(100.0 * precincts_reporting / precincts_total, 2)
+
+    return OrderedDict([
+        ('contest_name', contest_name),
+        ('leader', leader['choice_name']),
+        ('leader_party', leader.get('party_name')),
+        ('leader_votes', leader_votes),
+        ('runner_up', runner_up['choice_name'] if runner_up is not None else None),
+        ('runner_up_votes', runner_up_votes if runner_up is not None else None),
+        ('margin', margin),
+        ('margin_percent', margin_percent),
+        ('total_votes', total_votes),
+        ('registered_voters', registered_voters),
+        ('ballots_cast', ballots_cast),
+        ('turnout', turnout),
+        ('number_of_precincts_reporting', precincts_reporting),
+        ('total_number_of_precincts', precincts_total),
+        ('percent_of_precincts_reporting', percent_reporting),
+    ])
+
+def update_contest_aggregates(db, r_name, rows):
+    # Only contests whose rows differ from those seen on the last cycle
+    # are recomputed. The digests and the last computed aggregates live
+    # in the hash database, next to the 'election' table, and are only
+    # saved (by save_contest_aggregates) once they have been published.
+    table = db['contest_aggregates']
+    previous = {}
+    for entry in table.find(inferred_results=r_name):
+        previous[entry['contest_name']] = entry
+
+    now = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    aggregates = []
+    changed = []
+    digests = {}
+    for contest_name, contest_rows in group_by_contest(rows).items():
+        digest = contest_digest(contest_rows)
+        entry = previous.get(contest_name)
+        if entry is not None and entry['digest'] == digest:
+            aggregates.append(json.loads(entry['aggregate'], object_pairs_hook=OrderedDict))
+            continue
+        aggregate = compute_contest_aggregate(contest_name, contest_rows)
+        aggregate['updated_at'] = now
+        aggregates.append(aggregate)
+        changed.append(aggregate)
+        digests[contest_name] = digest
+
+    print("Recomputed aggregates for {} of {} contests.".format(len(changed), len(aggregates)))
+    return aggregates, changed, digests
+
+def save_contest_aggregates(db, r_name, changed, digests):
+    table = db['contest_aggregates']
+    for aggregate in changed:
+        contest_name = aggregate['contest_name']
+        table.upsert(dict(inferred_results=r_name, contest_name=contest_name, digest=digests[contest_name], aggregate=json.dumps(aggregate)), ['inferred_results', 'contest_name'])
+
+def aggregate_resource_name(r_name):
+    return r_name + ' by Contest'
+
+def write_aggregates_json(aggregates, r_name, output_dir):
+    ensure_directory(output_dir)
+    json_file = "{}/{}-contests.json".format(output_dir, slugify(r_name))
+    document = OrderedDict([
+        ('election', r_name),
+        ('generated_at', datetime.now().strftime("%Y-%m-%dT%H:%M:%S")),
+        ('contests', aggregates),
+    ])
+    temp_file = json_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(document, f)
+    os.replace(temp_file, json_file) # Never let a reader see a half-written file.
+    return json_file
+
+def publish_contest_aggregates(site, package_id, API_key, r_name, aggregates, changed, output_dir, resource_ids=None):
+    # resource_ids maps resource names to IDs cached by warmup.py, which
+    # saves looking the resources up.
+    resource_ids = resource_ids or {}
+    json_file = write_aggregates_json(aggregates, r_name, output_dir)
+    print("Wrote contest aggregates to {}".format(json_file))
+    if len(changed) == 0:
+        return json_file
+    resource_name = aggregate_resource_name(r_name)
+    upsert_records(site, package_id, resource_name, aggregate_fields, changed,
+        primary_key=['contest_name'], API_key=API_key, resource_id=resource_ids.get(resource_name))
+    upload_file(site, package_id, resource_name + ' (JSON)', json_file, API_key=API_key,
+        resource_id=resource_ids.get(resource_name + ' (JSON)'))
+    return json_file
@@ -0,0 +1,214 @@
+import time, threading
+from collections import deque
+from contextlib import contextmanager
+
+from discovery import percentile
+
+# A pool of long-lived headless Chrome sessions for the Selenium discovery
+# backend.
+#
+# Starting Chrome takes longer than everything else the Selenium backend
+# does, so rather than launching a browser for every poll and quitting it
+# afterwards, the pool keeps a few running and hands one out per discovery:
+#
+#   with pool.session() as driver:
+#       driver.get(url)
+#
+# A session is retired (and a replacement started in the background)
+# after max_uses discoveries, or right away if it raises an exception or
+# fails a health check when it's checked out, since a crashed Chrome
+# can't be reused. The pool only pays off in a long-running process (the
+# --watch mode of election_results_etl.py). In a one-off run, it holds a
+# single browser that is quit when the process exits.
+
+default_pool_settings = {
+    'size': 1,
+    'max_uses': 25, # Discoveries per session before it's replaced
+    'checkout_timeout': 120, # seconds to wait for a free session
+    'user_agent': "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/68.0.3440.84 Safari/537.36",
+    # The user agent avoids the 403 errors that started happening in headless mode in late 2022.
+    'window_size': "1920x1080",
+    'chromedriver_paths': ["/usr/local/bin/chromedriver", "/Users/drw/Apps/Internet/chromedriver"],
+    }
+
+class BrowserSession(object):
+    def __init__(self, driver, startup_seconds):
+        self.driver = driver
+        self.startup_seconds = startup_seconds
+        self.uses = 0
+
+class BrowserPool(object):
+    def __init__(self, settings=None, download_dir=None):
+        self.config = dict(default_pool_settings)
+        self.config.update(settings or {})
+        self.download_dir = download_dir
+        self.idle = deque()
+        self.starting = 0
+        self.in_use = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.counts = {'started': 0, 'start_failures': 0, 'recycled': 0, 'crashed': 0, 'checkouts': 0}
+        self.startup_latencies = deque(maxlen=50)
+        self.checkout_waits = deque(maxlen=50)
+
+    def launch_browser(self):
+        # Imported here so that the rest of the ETL doesn't need Selenium.
+        from selenium import webdriver
+        chrome_options = webdriver.ChromeOptions()
+        if self.download_dir is not None:
+            chrome_options.add_experimental_option('prefs', {'download.default_directory': self.download_dir})
+        chrome_options.add_argument("--headless") # Enable headless mode to allow ETL job to
+        chrome_options.add_argument("--window-size={}".format(self.config['window_size'])) # run when the screen is locked.
+        chrome_options.add_argument("user-agent={}".format(self.config['user_agent']))
+        last_error = None
+        for chromedriver_path in self.config['chromedriver_paths']:
+            try:
+                return webdriver.Chrome(chromedriver_path, chrome_options=chrome_options)
+            except Exception as e:
+                last_error = e
+        raise RuntimeError("Unable to start Chrome with any of the chromedrivers in {}: {}".format(self.config['chromedriver_paths'], last_error))
+
+    def start_session(self):
+        # Starts a browser and adds it to the idle sessions. The caller has
+        # already counted it in self.starting.
+        start = time.time()
+        try:
+            driver = self.launch_browser()
+        except Exception:
+            with self.condition:
+                self.starting -= 1
+                self.counts['start_failures'] += 1
+                self.condition.notify_all()
+            raise
+        session = BrowserSession(driver, time.time() - start)
+        with self.condition:
+            self.starting -= 1
+            self.counts['started'] += 1
+            self.startup_latencies.append(session.startup_seconds)
+            if self.closed:
+                quit_driver(driver)
+            else:
+                self.idle.append(session)
+            self.condition.notify_all()
+        print("Started a headless Chrome session in {:.1f} seconds.".format(session.startup_seconds))
+
+    def start_in_background(self):
+        with self.condition:
+            self.starting += 1
+        threading.Thread(target=self.start_session_quietly, daemon=True).start()
+
+    def start_session_quietly(self):
+        try:
+            self.start_session()
+        except Exception as e:
+            print("Unable to start a headless Chrome session in the background: {}".format(e))
+
+    def prewarm(self):
+        # Fills the pool in the background, so that the first discovery
+        # doesn't have to wait for Chrome to start.
+        with self.condition:
+            missing = self.config['size'] - len(self.idle) - self.starting - self.in_use
+        for _ in range(missing):
+            self.start_in_background()
+
+    def checkout(self):
+        wait_start = time.time()
+        start_here = False
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise RuntimeError("The browser pool has been closed.")
+                if len(self.idle) > 0:
+                    session = self.idle.popleft()
+                    self.in_use += 1
+                    break
+                if len(self.idle) + self.starting + self.in_use < self.config['size']:
+                    self.starting += 1
+                    start_here = True
+                    break
+                remaining = self.config['checkout_timeout'] - (time.time() - wait_start)
+                if remaining <= 0:
+                    raise RuntimeError("No headless Chrome session became free within {} seconds.".format(self.config['checkout_timeout']))
+                self.condition.wait(remaining)
+        if start_here:
+            self.start_session()
+            return self.checkout()
+        if not is_alive(session.driver):
+            print("A pooled headless Chrome session had crashed. Replacing it.")
+            self.retire(session, crashed=True)
+            return self.checkout()
+        with self.condition:
+            self.counts['checkouts'] += 1
+            self.checkout_waits.append(time.time() - wait_start)
+        return session
+
+    def retire(self, session, crashed=False):
+        quit_driver(session.driver)
+        with self.condition:
+            self.in_use -= 1
+            self.counts['crashed' if crashed else 'recycled'] += 1
+            self.condition.notify_all()
+        if not self.closed:
+            self.start_in_background()
+
+    def checkin(self, session):
+        session.uses += 1
+        if session.uses >= self.config['max_uses']:
+            self.retire(session)
+            return
+        with self.condition:
+            self.in_use -= 1
+            if self.closed:
+                quit_driver(session.driver)
+            else:
+                self.idle.append(session)
+            self.condition.notify_all()
+
+    @contextmanager
+    def session(self):
+        session = self.checkout()
+        try:
+            yield session.driver
+        except Exception:
+            # The page may have been left in any state (or Chrome may have
+            # died), so don't hand this session out again.
+            self.retire(session, crashed=True)
+            raise
+        else:
+            self.checkin(session)
+
+    def metrics(self):
+        with self.condition:
+            return {
+                'size': self.config['size'],
+                'idle': len(self.idle),
+                'in_use': self.in_use,
+                'starting': self.starting,
+                'startup_p50_seconds': percentile(list(self.startup_latencies), 50),
+                'startup_max_seconds': max(self.startup_latencies) if len(self.startup_latencies) > 0 else None,
+                'checkout_wait_p50_seconds': percentile(list(self.checkout_waits), 50),
+                'checkout_wait_max_seconds': max(self.checkout_waits) if len(self.checkout_waits) > 0 else None,
+                **self.counts
+                }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            sessions = list(self.idle)
+            self.idle.clear()
+            self.condition.notify_all()
+        for session in sessions:
+            quit_driver(session.driver)
+
+def is_alive(driver):
+    try:
+        driver.current_url
+        return True
+    except Exception:
+        return False
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except Exception:
+        pass
@@ -0,0 +1,224 @@
+import sys, json, gzip, hashlib, threading, argparse
+from collections import OrderedDict
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, unquote
+
+import requests
+
+from aggregates import group_by_contest, compute_contest_aggregate
+from publishing import slugify
+
+# A read-through cache of the latest results, so that read traffic on
+# election night doesn't land on the CKAN datastore that the ETL is
+# writing to.
+#
+# After every changed cycle, the ETL POSTs the validated summary rows
+# (dumped through the schema, so with the datastore's column names) and
+# the contest aggregates to /ingest. The server builds every response once per ingest and keeps it
+# in memory, both plain and gzipped, with a strong ETag (a SHA-256 of the
+# response body). Requests with a matching If-None-Match get a 304 with
+# no body. The paths are
+#   /elections                                  the elections held in the cache
+#   /elections/<election>/summary.json          all of the summary rows
+#   /elections/<election>/contests.json         one aggregate per contest
+#   /elections/<election>/contests/<contest>.json   one contest's rows and aggregate
+# where <election> and <contest> are slugified names, and 'latest' can
+# stand in for the election last ingested.
+#
+# To feed it from the ETL, start it
+#   python cache_server.py --port 8080 --token <secret>
+# and add to the settings file
+#   "cache_server": {"ingest_url": "http://localhost:8080/ingest", "token": "<secret>"}
+
+class Representation(object):
+    def __init__(self, document):
+        self.body = json.dumps(document, default=str).encode('utf-8')
+        self.gzipped = gzip.compress(self.body)
+        self.etag = '"{}"'.format(hashlib.sha256(self.body).hexdigest())
+        # A different encoding is a different representation, so it needs
+        # its own strong ETag.
+        self.gzipped_etag = '"{}-gzip"'.format(hashlib.sha256(self.body).hexdigest())
+
+def build_election(r_name, rows, aggregates, received):
+    # Returns the responses for one election, keyed by path.
+    slug = slugify(r_name)
+    contests = group_by_contest(rows)
+    by_contest = {aggregate['contest_name']: aggregate for aggregate in aggregates}
+    resources = {}
+    resources['/elections/{}/summary.json'.format(slug)] = Representation(OrderedDict([
+        ('election', r_name), ('updated', received), ('rows', sorted(rows, key=lambda r: r['line_number']))]))
+    resources['/elections/{}/contests.json'.format(slug)] = Representation(OrderedDict([
+        ('election', r_name), ('updated', received), ('contests', aggregates)]))
+    for contest_name, contest_rows in contests.items():
+        resources['/elections/{}/contests/{}.json'.format(slug, slugify(contest_name))] = Representation(OrderedDict([
+            ('election', r_name), ('updated', received), ('contest', by_contest.get(contest_name)), ('rows', contest_rows)]))
+    return slug, resources
+
+class ResultsCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.elections = OrderedDict() # slug => (name, updated, resources)
+        self.latest = None
+        self.index = None
+
+    def ingest(self, r_name, rows, aggregates):
+        received = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        # Everything is built before the swap, so readers never see a
+        # half-updated election.
+        slug, resources = build_election(r_name, rows, aggregates, received)
+        with self.lock:
+            self.elections[slug] = (r_name, received, resources)
+            self.latest = slug
+            index = [OrderedDict([('election', name), ('slug', s), ('updated', updated)]) for s, (name, updated, _) in self.elections.items()]
+            self.index = Representation(OrderedDict([('latest', self.latest), ('elections', index)]))
+        return slug, len(resources)
+
+    def lookup(self, path):
+        with self.lock:
+            if path == '/elections':
+                return self.index
+            parts = path.split('/')
+            if len(parts) < 4 or parts[1] != 'elections':
+                return None
+            slug = self.latest if parts[2] == 'latest' else parts[2]
+            if slug not in self.elections:
+                return None
+            parts[2] = slug
+            return self.elections[slug][2].get('/'.join(parts))
+
+def accepts_gzip(accept_encoding):
+    # Parses the Accept-Encoding header, q-values included, so that
+    # 'gzip;q=0' turns gzip off. An explicit gzip entry takes precedence
+    # over '*'.
+    q_values = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if coding == '':
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        q_values[coding] = q
+    for coding in ['gzip', 'x-gzip', '*']:
+        if coding in q_values:
+            return q_values[coding] > 0
+    return False
+
+def make_handler(cache, token, max_age):
+    class Handler(BaseHTTPRequestHandler):
+        def respond_json(self, status, document):
+            body = json.dumps(document).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json;charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def serve(self, include_body):
+            path = unquote(urlparse(self.path).path).rstrip('/')
+            representation = cache.lookup(path)
+            if representation is None:
+                self.respond_json(404, {'error': 'Not found'})
+                return
+            use_gzip = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+            etag = representation.gzipped_etag if use_gzip else representation.etag
+            if_none_match = [t.strip() for t in self.headers.get('If-None-Match', '').split(',')]
+            if etag in if_none_match or '*' in if_none_match:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'public, max-age={}'.format(max_age))
+                self.send_header('Vary', 'Accept-Encoding')
+                self.end_headers()
+                return
+            body = representation.gzipped if use_gzip else representation.body
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json;charset=utf-8')
+            if use_gzip:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'public, max-age={}'.format(max_age))
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            if include_body:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            self.serve(True)
+
+        def do_HEAD(self):
+            self.serve(False)
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/ingest':
+                self.respond_json(404, {'error': 'Not found'})
+                return
+            if token is not None and self.headers.get('Authorization') != 'Bearer {}'.format(token):
+                self.respond_json(403, {'error': 'Forbidden'})
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                document = json.loads(self.rfile.read(length).decode('utf-8'))
+                slug, count = cache.ingest(document['election'], document['rows'], document['contests'])
+            except (ValueError, KeyError, TypeError) as e:
+                self.respond_json(400, {'error': "Unable to ingest the results: {}".format(e)})
+                return
+            self.respond_json(200, {'election': slug, 'resources': count})
+
+        def log_message(self, format, *args):
+            sys.stderr.write("[results cache] {}\n".format(format % args))
+
+    return Handler
+
+def serve(port=8080, host='localhost', token=None, max_age=10):
+    server = ThreadingHTTPServer((host, port), make_handler(ResultsCache(), token, max_age))
+    print("Results cache listening on http://{}:{}".format(host, port))
+    return server
+
+def feed_cache(settings, schema, r_name, rows):
+    # Called by the ETL after a changed cycle, with the validated (loaded)
+    # summary rows. The cache is optional, so a failure here is reported
+    # but doesn't fail the cycle.
+    cache_settings = settings.get('cache_server')
+    if cache_settings is None or 'ingest_url' not in cache_settings:
+        return False
+    # The aggregates are computed from the loaded rows (whose attribute
+    # names compute_contest_aggregate() expects), and the rows are dumped
+    # through the schema so that readers see the same column names as in
+    # the datastore (as columnar.py does for the exports).
+    aggregates = [compute_contest_aggregate(contest_name, contest_rows) for contest_name, contest_rows in group_by_contest(rows).items()]
+    dumped, errors = schema(many=True).dump(rows)
+    headers = {'Content-Type': 'application/json'}
+    if cache_settings.get('token') is not None:
+        headers['Authorization'] = 'Bearer {}'.format(cache_settings['token'])
+    try:
+        r = requests.post(cache_settings['ingest_url'], data=json.dumps({'election': r_name, 'rows': dumped, 'contests': aggregates}, default=str),
+            headers=headers, timeout=cache_settings.get('timeout', 10))
+    except requests.exceptions.RequestException as e:
+        print("Unable to feed the results cache: {}".format(e))
+        return False
+    if r.status_code != 200:
+        print("The results cache refused the results (status code {}): {}".format(r.status_code, r.text[:200]))
+        return False
+    print("Fed {} to the results cache.".format(r_name))
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the latest election results from memory.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--token', default=None, help='Bearer token that the ETL must send to /ingest')
+    parser.add_argument('--max-age', type=int, default=10, help='Cache-Control max-age (in seconds)')
+    args = parser.parse_args()
+    server = serve(args.port, args.host, args.token, args.max_age)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,108 @@
+from publishing import upload_file, slugify, ensure_directory
+
+# Typed, compressed columnar (Parquet and, optionally, Arrow IPC) exports
+# of a whole election, so that analysts can load it into pandas with one
+# download instead of paging through the datastore API or parsing XML.
+#
+# pyarrow is only needed when exports are actually written, so it's
+# imported inside the functions that use it, the same way that the
+# Selenium imports are deferred in election_results_etl.py.
+
+precinct_columns = ['contest_name', 'choice_name', 'party_name', 'vote_type', 'precinct_name', 'votes']
+
+def arrow_type(pa, ckan_type):
+    ckan_to_arrow = {
+        'int': pa.int64(),
+        'integer': pa.int64(),
+        'float': pa.float64(),
+        'numeric': pa.float64(),
+        'bool': pa.bool_(),
+        'boolean': pa.bool_(),
+        'timestamp': pa.timestamp('s'),
+        'date': pa.date32(),
+        }
+    return ckan_to_arrow.get(ckan_type, pa.string())
+
+def summary_table(pa, schema, rows, fields):
+    # The rows are the validated (loaded) summary rows; dumping them
+    # through the schema gives them the same column names (dump_to) as
+    # the datastore table, and the CKAN field types give the column types.
+    dumped, errors = schema(many=True).dump(rows)
+    arrow_schema = pa.schema([(f['id'], arrow_type(pa, f['type'])) for f in fields])
+    columns = {f['id']: [row.get(f['id']) for row in dumped] for f in fields}
+    return pa.Table.from_pydict(columns, schema=arrow_schema)
+
+def precinct_table(pa, precinct_votes):
+    arrow_schema = pa.schema([
+        ('contest_name', pa.string()),
+        ('choice_name', pa.string()),
+        ('party_name', pa.string()),
+        ('vote_type', pa.string()),
+        ('precinct_name', pa.string()),
+        ('votes', pa.int64()),
+        ])
+    columns = [[] for _ in precinct_columns]
+    for record in precinct_votes:
+        for k, value in enumerate(record):
+            columns[k].append(value)
+    table = pa.Table.from_arrays([pa.array(c, type=t) for c, t in zip(columns, arrow_schema.types)], schema=arrow_schema)
+    # The string columns are extremely repetitive (~1300 precincts times
+    # every choice), so dictionary-encode them.
+    for name in ['contest_name', 'choice_name', 'party_name', 'vote_type', 'precinct_name']:
+        k = table.schema.get_field_index(name)
+        table = table.set_column(k, name, table.column(name).dictionary_encode())
+    return table
+
+def write_table(table, base_file, arrow=False):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    files = []
+    parquet_file = base_file + '.parquet'
+    pq.write_table(table, parquet_file, compression='zstd')
+    files.append(parquet_file)
+    if arrow:
+        arrow_file = base_file + '.arrow'
+        options = pa.ipc.IpcWriteOptions(compression='zstd')
+        with pa.OSFile(arrow_file, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+        files.append(arrow_file)
+    return files
+
+def write_columnar_exports(schema, rows, fields, precinct_votes, output_dir, r_name, arrow=False):
+    # Returns a list of (file path, resource name) pairs.
+    try:
+        import pyarrow as pa
+    except ImportError:
+        print("pyarrow is not installed, so no columnar exports will be written.")
+        return []
+    ensure_directory(output_dir)
+    base = "{}/{}".format(output_dir, slugify(r_name))
+    exports = []
+    for f in write_table(summary_table(pa, schema, rows, fields), base + '-summary', arrow):
+        exports.append((f, "{} ({})".format(r_name, export_format(f))))
+    if precinct_votes is not None:
+        for f in write_table(precinct_table(pa, precinct_votes), base + '-by-precinct', arrow):
+            exports.append((f, "{} by Precinct ({})".format(r_name, export_format(f))))
+    return exports
+
+def export_format(file_path):
+    if file_path.endswith('.arrow'):
+        return 'Arrow IPC'
+    return 'Parquet'
+
+def export_resource_names(r_name, arrow=False):
+    # The names of the resources that write_columnar_exports() will
+    # produce (none, if pyarrow isn't installed).
+    try:
+        import pyarrow
+    except ImportError:
+        return []
+    formats = ['Parquet', 'Arrow IPC'] if arrow else ['Parquet']
+    return ["{}{} ({})".format(r_name, part, f) for part in ['', ' by Precinct'] for f in formats]
+
+def publish_columnar_exports(site, package_id, API_key, exports, resource_ids=None):
+    resource_ids = resource_ids or {}
+    for export_file, resource_name in exports:
+        print("Uploading {} to {}".format(export_file, resource_name))
+        upload_file(site, package_id, resource_name, export_file, API_key=API_key, resource_id=resource_ids.get(resource_name))
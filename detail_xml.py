@@ -0,0 +1,71 @@
+from zipfile import PyZipFile
+from lxml import etree
+
+# Readers for the precinct-level detail.xml file found in Clarity's
+# detailxml.zip. The file looks roughly like this:
+#
+#   <ElectionResult>
+#     <VoterTurnout totalVoters="..." ballotsCast="..." voterTurnout="...">
+#       <Precincts>
+#         <Precinct name="Aleppo" totalVoters="..." ballotsCast="..." voterTurnout="..." percentReporting="..."/>
+#       </Precincts>
+#     </VoterTurnout>
+#     <Contest key="1" text="President of the United States" ...>
+#       <Choice key="1" text="..." party="DEM" totalVotes="...">
+#         <VoteType voteType="Election Day" votes="...">
+#           <Precinct name="Aleppo" votes="..."/>
+#         </VoteType>
+#       </Choice>
+#     </Contest>
+#   </ElectionResult>
+#
+# The file for a general election is tens of megabytes, so it's streamed
+# with iterparse and each Contest element is discarded once it's been read.
+
+def open_detail_xml(xml_zip):
+    zf = PyZipFile(xml_zip)
+    return zf.open('detail.xml')
+
+def to_int(value):
+    if value is None or value == '':
+        return None
+    return int(float(value))
+
+def to_float(value):
+    if value is None or value == '':
+        return None
+    return float(value)
+
+def iter_precinct_votes(xml_zip):
+    # Yields (contest_name, choice_name, party_name, vote_type, precinct_name, votes)
+    # tuples, one per precinct per vote type per choice.
+    with open_detail_xml(xml_zip) as f:
+        for event, contest in etree.iterparse(f, events=('end',), tag='Contest'):
+            contest_name = contest.get('text')
+            for choice in contest.iterfind('Choice'):
+                choice_name = choice.get('text')
+                party_name = choice.get('party') or None
+                for vote_type in choice.iterfind('VoteType'):
+                    vote_type_name = vote_type.get('voteType') or vote_type.get('name')
+                    for precinct in vote_type.iterfind('Precinct'):
+                        yield (contest_name, choice_name, party_name, vote_type_name, precinct.get('name'), to_int(precinct.get('votes')) or 0)
+            contest.clear()
+            while contest.getprevious() is not None:
+                del contest.getparent()[0]
+
+def read_precinct_turnout(xml_zip):
+    # Returns one dict per precinct from the VoterTurnout section.
+    turnout = []
+    with open_detail_xml(xml_zip) as f:
+        for event, element in etree.iterparse(f, events=('end',), tag='VoterTurnout'):
+            for precinct in element.iterfind('Precincts/Precinct'):
+                turnout.append({
+                    'precinct_name': precinct.get('name'),
+                    'registered_voters': to_int(precinct.get('totalVoters')),
+                    'ballots_cast': to_int(precinct.get('ballotsCast')),
+                    'voter_turnout': to_float(precinct.get('voterTurnout')),
+                    'percent_reporting': to_float(precinct.get('percentReporting')),
+                    })
+            element.clear()
+            break # There's only one VoterTurnout element.
+    return turnout
@@ -0,0 +1,221 @@
+import re, sys, time, queue, threading
+import requests
+from urllib.parse import urlparse, urlunparse
+
+# Browserless discovery of Clarity report URLs.
+#
+# The link on the County's landing page looks like
+#   'http://results.enr.clarityelections.com/PA/Allegheny/71801/Web02/#/'
+# where 71801 is the election ID. The reports themselves live under a
+# second, changing number (the report version):
+#   'https://results.enr.clarityelections.com//PA/Allegheny/71801/189912/reports/summary.zip'
+# Rather than rendering the page to find that number, ask Clarity for it
+# directly. It's served as plain text from
+#   'https://results.enr.clarityelections.com/PA/Allegheny/71801/current_ver.txt'
+
+class DiscoveryError(RuntimeError):
+    pass
+
+def parse_election_url(url, root_url=None):
+    # Returns the base URL of the election (everything up to and including
+    # the election ID) and the election ID itself. Giving root_url (e.g.,
+    # 'http://localhost:8000') swaps out the scheme and host, which makes
+    # it possible to test discovery against a local stub of the Clarity site.
+    parsed = urlparse(url)
+    segments = [s for s in parsed.path.split('/') if s != '']
+    for k, segment in enumerate(segments):
+        if re.match(r'^\d+$', segment):
+            election_id = segment
+            election_path = '/' + '/'.join(segments[:k + 1])
+            break
+    else:
+        raise DiscoveryError("Unable to find an election ID in {}".format(url))
+
+    if root_url is not None:
+        root = urlparse(root_url)
+        scheme, netloc = root.scheme, root.netloc
+        election_path = root.path.rstrip('/') + election_path
+    else:
+        scheme, netloc = 'https', parsed.netloc
+    base_url = urlunparse((scheme, netloc, election_path, '', '', ''))
+    return base_url, election_id
+
+def fetch_current_version(base_url, headers=None, timeout=10):
+    try:
+        r = requests.get(base_url + '/current_ver.txt', headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        raise DiscoveryError("Unable to reach {}/current_ver.txt: {}".format(base_url, e))
+    if r.status_code != 200:
+        raise DiscoveryError("{}/current_ver.txt returned status code {}".format(base_url, r.status_code))
+    version = r.text.strip()
+    if re.match(r'^\d+$', version) is None:
+        raise DiscoveryError("Unexpected contents of {}/current_ver.txt: {}".format(base_url, version[:100]))
+    return version
+
+def check_url(file_url, headers=None, timeout=10):
+    # A HEAD request is cheap and keeps a bad guess from being mistaken for
+    # a successful discovery.
+    try:
+        r = requests.head(file_url, headers=headers, timeout=timeout, allow_redirects=True)
+    except requests.exceptions.RequestException as e:
+        raise DiscoveryError("Unable to reach {}: {}".format(file_url, e))
+    if r.status_code != 200:
+        raise DiscoveryError("{} returned status code {}".format(file_url, r.status_code))
+
+def discover_report_urls(url, headers=None, timeout=10, root_url=None, verify=True):
+    # Returns the URLs of summary.zip and detailxml.zip for the election
+    # whose landing page is url, or raises a DiscoveryError.
+    base_url, election_id = parse_election_url(url, root_url)
+    version = fetch_current_version(base_url, headers, timeout)
+    reports_url = "{}/{}/reports".format(base_url, version)
+    summary_file_url = reports_url + '/summary.zip'
+    xml_file_url = reports_url + '/detailxml.zip'
+    if verify:
+        check_url(summary_file_url, headers, timeout)
+        check_url(xml_file_url, headers, timeout)
+    print("Discovered report version {} for election {} without rendering the page.".format(version, election_id))
+    return summary_file_url, xml_file_url
+
+# A fallback chain of discovery backends.
+#
+# Each backend is a dict like
+#   {'name': 'clarity', 'function': discover_report_urls, 'timeout': 30}
+# where the function takes the landing-page URL and returns the summary
+# file URL and the XML file URL (or raises an exception). A function
+# should pass the backend's timeout on to its own HTTP requests. Backends are
+# tried in order. A backend that fails failure_threshold times in a row
+# has its circuit breaker opened and is skipped until cooldown seconds
+# have passed, after which it gets one trial call. With hedging turned on,
+# if a backend runs longer than its 90th-percentile latency, the next
+# backend is started alongside it and whichever answers first wins.
+#
+# Since every poll is a separate cron invocation, the breaker state and
+# the latency history are kept in a small SQLite database (a dataset
+# connection, like the hash databases).
+
+default_discovery_settings = {
+    'hedge': False,
+    'failure_threshold': 3,
+    'cooldown': 600, # seconds
+    'latency_window': 50, # Number of recent successful calls used for the p90
+    'min_latency_samples': 5,
+    }
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(q / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+def breaker_is_open(db, backend_name, failure_threshold, cooldown):
+    entry = db['circuit_breakers'].find_one(backend=backend_name)
+    if entry is None or entry['consecutive_failures'] < failure_threshold:
+        return False
+    # After the cooldown, the breaker is half-open: let one call through.
+    return time.time() - entry['opened_at'] < cooldown
+
+def record_success(db, backend_name, seconds):
+    db['circuit_breakers'].upsert(dict(backend=backend_name, consecutive_failures=0, opened_at=0.0), ['backend'])
+    db['backend_latencies'].insert(dict(backend=backend_name, seconds=seconds, recorded_at=time.time()))
+
+def record_failure(db, backend_name):
+    entry = db['circuit_breakers'].find_one(backend=backend_name)
+    failures = 1 if entry is None else entry['consecutive_failures'] + 1
+    db['circuit_breakers'].upsert(dict(backend=backend_name, consecutive_failures=failures, opened_at=time.time()), ['backend'])
+    return failures
+
+def p90_latency(db, backend_name, settings):
+    recent = db['backend_latencies'].find(backend=backend_name, order_by='-recorded_at', _limit=settings['latency_window'])
+    latencies = [entry['seconds'] for entry in recent]
+    if len(latencies) < settings['min_latency_samples']:
+        return None
+    return percentile(latencies, 90)
+
+def discover_with_fallbacks(url, backends, db, settings=None):
+    # Returns (summary_file_url, xml_file_url, name of the backend that
+    # answered) or raises a DiscoveryError once every backend has failed.
+    config = dict(default_discovery_settings)
+    config.update(settings or {})
+
+    available = []
+    for backend in backends:
+        if breaker_is_open(db, backend['name'], config['failure_threshold'], config['cooldown']):
+            print("Skipping the {} discovery backend, since its circuit breaker is open.".format(backend['name']))
+        else:
+            available.append(backend)
+    if len(available) == 0:
+        raise DiscoveryError("Every discovery backend is switched off by its circuit breaker.")
+
+    # Each call runs on a daemon thread. A call that times out can't be
+    # stopped, but a daemon thread (unlike a ThreadPoolExecutor's workers)
+    # doesn't keep the process alive at exit, so an abandoned call can't
+    # hold up the cron job. The backends should still put timeouts on
+    # their own network calls.
+    answers = queue.Queue()
+    running = {} # backend name => (backend, start time, hedge deadline)
+    errors = []
+    pending = list(available)
+
+    def call(backend):
+        try:
+            answers.put((backend['name'], backend['function'](url), None))
+        except Exception as e:
+            answers.put((backend['name'], None, e))
+
+    def launch():
+        backend = pending.pop(0)
+        hedge_after = p90_latency(db, backend['name'], config) if config['hedge'] else None
+        start = time.time()
+        hedge_deadline = start + hedge_after if hedge_after is not None else None
+        running[backend['name']] = (backend, start, hedge_deadline) # Each backend is called at most once.
+        threading.Thread(target=call, args=(backend,), daemon=True).start()
+
+    def fail(backend, reason):
+        failures = record_failure(db, backend['name'])
+        errors.append("{}: {}".format(backend['name'], reason))
+        print("The {} discovery backend failed ({} in a row): {}".format(backend['name'], failures, reason))
+
+    launch()
+    while len(running) > 0:
+        now = time.time()
+        deadlines = []
+        for backend, start, hedge_deadline in running.values():
+            deadlines.append(start + backend['timeout'])
+            if hedge_deadline is not None and len(pending) > 0:
+                deadlines.append(hedge_deadline)
+        try:
+            name, answer, error = answers.get(timeout=max(0, min(deadlines) - now))
+        except queue.Empty:
+            name = None
+        if name in running: # Answers from abandoned calls are ignored.
+            backend, start, hedge_deadline = running.pop(name)
+            if error is None:
+                summary_file_url, xml_file_url = answer
+                record_success(db, backend['name'], time.time() - start)
+                return summary_file_url, xml_file_url, backend['name']
+            fail(backend, error)
+
+        now = time.time()
+        hedge_due = False
+        for name, (backend, start, hedge_deadline) in list(running.items()):
+            if now - start >= backend['timeout']:
+                # The thread can't be killed, but its answer will be ignored.
+                running.pop(name)
+                fail(backend, "timed out after {} seconds".format(backend['timeout']))
+            elif hedge_deadline is not None and now >= hedge_deadline:
+                running[name] = (backend, start, None) # Only hedge each call once.
+                hedge_due = True
+                print("The {} discovery backend is slower than its p90 latency. Hedging.".format(backend['name']))
+
+        if len(pending) > 0 and (len(running) == 0 or hedge_due):
+            launch()
+
+    raise DiscoveryError("Every discovery backend failed. " + "; ".join(errors))
+
+if __name__ == '__main__':
+    # Usage: python discovery.py <landing-page URL> [<root URL of a local stub>]
+    root_url = sys.argv[2] if len(sys.argv) > 2 else None
+    summary_file_url, xml_file_url = discover_report_urls(sys.argv[1], root_url=root_url)
+    print("summary_file_url = {}".format(summary_file_url))
+    print("xml_file_url = {}".format(xml_file_url))
@@ -0,0 +1,70 @@
+import os, json
+
+from publishing import slugify, ensure_directory
+
+# Jurisdictions whose Clarity results can be mirrored.
+#
+# Clarity hosts results for many counties in the same format, so the only
+# things that differ from one county to the next are where the list of
+# elections is, how to pick the election out of that page, which CKAN
+# package to publish to, and the encoding of the CSV file. A jurisdiction
+# config file is a JSON list of entries like
+#
+#   [{"name": "butler",
+#     "landing_url": "https://www.butlercountypa.gov/election-results",
+#     "title_xpath": "//table/tbody/tr[{}]/td[1]/a/text()",
+#     "link_xpath": "//table/tbody/tr[{}]/td[1]/a",
+#     "election_index": 1,
+#     "encoding": "utf-8",
+#     "resource_name_prefix": "Butler County ",
+#     "packages": {"test": "<package ID>", "production": "<package ID>"},
+#     "min_interval": 300}]
+#
+# Only "name" and "landing_url" are required; everything else defaults to
+# the values for Allegheny County below, except "verify" (whether to check
+# the landing page's TLS certificate), which defaults to true. Only
+# Allegheny County's entry turns it off, to work around its certificate. Leaving out "packages" publishes
+# to the package given for the server in the settings file. min_interval
+# (in seconds) is the shortest time between two cycles of the jurisdiction,
+# which keeps the supervisor from polling any one county too often.
+
+default_jurisdiction = {
+    'name': 'allegheny',
+    'landing_url': "http://www.alleghenycounty.us/elections/election-results.aspx",
+    'title_xpath': '//table/tbody/tr[{}]/td[2]/a/text()',
+    'link_xpath': '//table/tbody/tr[{}]/td[2]/a',
+    'election_index': 1, # Manually increment this to re-pull older elections
+    'resource_name_prefix': '',
+    'packages': {},
+    'min_interval': 0, # seconds
+    'verify': False, # Allegheny County's certificate doesn't check out.
+    }
+
+def load_jurisdictions(config_file):
+    with open(config_file) as f:
+        entries = json.load(f)
+    jurisdictions = []
+    names = set()
+    for entry in entries:
+        for key in ['name', 'landing_url']:
+            if key not in entry:
+                raise ValueError("A jurisdiction in {} is missing '{}'.".format(config_file, key))
+        if entry['name'] in names:
+            raise ValueError("The jurisdiction '{}' appears twice in {}.".format(entry['name'], config_file))
+        names.add(entry['name'])
+        jurisdiction = dict(default_jurisdiction)
+        if entry['name'] != default_jurisdiction['name']:
+            jurisdiction['verify'] = True
+        jurisdiction.update(entry)
+        jurisdictions.append(jurisdiction)
+    return jurisdictions
+
+def jurisdiction_state_dir(root_dir, jurisdiction):
+    # Each jurisdiction keeps its own hash databases, locks, snapshots and
+    # temporary files. Allegheny County's stay where they've always been.
+    if jurisdiction['name'] == default_jurisdiction['name']:
+        return root_dir
+    return ensure_directory(os.path.join(root_dir, 'shards', slugify(jurisdiction['name'])))
+
+def package_for(jurisdiction, server, settings):
+    return jurisdiction['packages'].get(server, settings['loader'][server]['package_id'])
@@ -0,0 +1,78 @@
+import time
+from datetime import datetime
+
+from discovery import percentile
+
+# Time-to-publish tracking.
+#
+# For every changed summary file, three times are known:
+#   county_published  the date_time of summary.csv inside the zip file
+#                     (the same last_modified that is_changed() extracts)
+#   first_seen        the first poll that downloaded this version of the
+#                     file (a cycle that fails after detecting a change
+#                     leaves the sighting for the cycle that publishes it)
+#   published_at      when our datastore upsert finished
+# from which come the detection lag (first_seen - county_published),
+# which is governed by the polling frequency, and the publish lag
+# (published_at - county_published), which is what readers experience.
+#
+# The zip file's timestamps have no time zone. They're taken to be in the
+# same time zone as this machine (true for Allegheny County), and
+# clock_offset (in seconds) can be set to correct for any difference.
+#
+# Rolling p50/p95 values over the last window cycles of each election are
+# printed every cycle. The admins are alerted only when the p95 publish
+# lag goes over the SLO (publish_lag_slo seconds), and not again until
+# it has recovered.
+
+default_latency_settings = {
+    'window': 20, # Number of recent cycles in the rolling percentiles
+    'publish_lag_slo': 900, # seconds
+    'clock_offset': 0, # seconds to add to the county's timestamps
+    }
+
+def record_sighting(db, r_name, hash_value, seen_at=None):
+    # Returns the time this version of the file was first seen.
+    table = db['version_sightings']
+    sighting = table.find_one(election=r_name, hash=hash_value)
+    if sighting is not None:
+        return sighting['first_seen']
+    seen_at = seen_at if seen_at is not None else time.time()
+    table.insert(dict(election=r_name, hash=hash_value, first_seen=seen_at))
+    return seen_at
+
+def rolling_percentiles(values):
+    p50, p95 = percentile(values, 50), percentile(values, 95)
+    return (round(p50, 1) if p50 is not None else None), (round(p95, 1) if p95 is not None else None)
+
+def record_publish_latency(db, r_name, hash_value, last_modified, published_at, settings=None, notify=None):
+    config = dict(default_latency_settings)
+    config.update(settings or {})
+    if last_modified is None:
+        return None
+    county_published = time.mktime(last_modified.timetuple()) + config['clock_offset']
+    first_seen = record_sighting(db, r_name, hash_value, published_at)
+    publish_lag = published_at - county_published
+    detection_lag = first_seen - county_published
+    db['publish_latencies'].insert(dict(election=r_name, hash=hash_value,
+        county_published=last_modified.strftime("%Y-%m-%d %H:%M:%S"),
+        first_seen=first_seen, published_at=published_at,
+        detection_lag=detection_lag, publish_lag=publish_lag))
+
+    recent = list(db['publish_latencies'].find(election=r_name, order_by='-published_at', _limit=config['window']))
+    publish_p50, publish_p95 = rolling_percentiles([entry['publish_lag'] for entry in recent])
+    detection_p50, detection_p95 = rolling_percentiles([entry['detection_lag'] for entry in recent])
+    print("Time to publish for {}: {:.0f} seconds (detection lag {:.0f} seconds). Over the last {} cycles: publish lag p50 = {}, p95 = {}; detection lag p50 = {}, p95 = {}.".format(
+        r_name, publish_lag, detection_lag, len(recent), publish_p50, publish_p95, detection_p50, detection_p95))
+
+    state = db['slo_state'].find_one(election=r_name)
+    was_breached = state is not None and state['breached']
+    breached = publish_p95 > config['publish_lag_slo']
+    if breached and not was_breached and notify is not None:
+        notify("The p95 time to publish for {} is {} seconds, over the SLO of {} seconds (p50 = {} seconds; detection lag p95 = {} seconds).".format(
+            r_name, publish_p95, config['publish_lag_slo'], publish_p50, detection_p95))
+    elif was_breached and not breached:
+        print("The p95 time to publish for {} is back under the SLO of {} seconds.".format(r_name, config['publish_lag_slo']))
+    db['slo_state'].upsert(dict(election=r_name, breached=breached, updated=datetime.now().strftime("%Y-%m-%d %H:%M:%S")), ['election'])
+    return dict(publish_lag=publish_lag, detection_lag=detection_lag, publish_p50=publish_p50, publish_p95=publish_p95,
+        detection_p50=detection_p50, detection_p95=detection_p95, breached=breached)
@@ -0,0 +1,465 @@
+import os, re, sys, json, time, uuid, random, sqlite3, threading, argparse, traceback
+from datetime import datetime
+from email import policy
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+# A local stand-in for a CKAN instance, backed by SQLite, for testing the
+# publishing paths (and their performance) without the real test server.
+#
+# It implements the subset of the action API that this project uses:
+#   package_show, resource_show, resource_create, resource_update,
+#   resource_patch, resource_delete, datastore_create, datastore_upsert,
+#   datastore_search and datastore_delete
+# including file uploads, which are saved under the data directory and
+# served back from /uploads/. Any package ID is accepted and the package
+# is created on first use.
+#
+# To point the ETL at it, start it
+#   python local_ckan.py --port 5050 --latency 0.2 --error-rate 0.05
+# and add a server to the 'loader' section of the settings file
+#   "local": {"ckan_root_url": "http://localhost:5050",
+#             "package_id": "election-results", "ckan_api_key": "local"}
+# then run the ETL with 'local' as the server argument.
+
+datastore_types = {
+    'int': 'INTEGER', 'int4': 'INTEGER', 'int8': 'INTEGER', 'integer': 'INTEGER', 'bigint': 'INTEGER',
+    'bool': 'INTEGER', 'boolean': 'INTEGER',
+    'float': 'REAL', 'float8': 'REAL', 'numeric': 'REAL', 'double precision': 'REAL',
+    }
+
+class ActionError(Exception):
+    def __init__(self, status, error_type, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.error_type = error_type
+        self.message = message
+
+def not_found(message):
+    return ActionError(404, 'Not Found Error', message)
+
+def validation_error(message):
+    return ActionError(409, 'Validation Error', message)
+
+def now_string():
+    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+def table_name(resource_id):
+    return 'datastore_' + re.sub('[^a-zA-Z0-9]', '_', resource_id)
+
+def quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+def as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(',') if v.strip() != '']
+    return list(value)
+
+class LocalCKAN(object):
+    def __init__(self, data_dir, base_url):
+        self.data_dir = data_dir
+        self.base_url = base_url
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        self.connection = sqlite3.connect(os.path.join(data_dir, 'ckan.db'), check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS packages (id TEXT PRIMARY KEY, name TEXT, metadata_created TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS resources (id TEXT PRIMARY KEY, package_id TEXT, name TEXT, url TEXT, url_type TEXT, "
+                "datastore_active INTEGER DEFAULT 0, position INTEGER, created TEXT, last_modified TEXT, extras TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS datastore_tables (resource_id TEXT PRIMARY KEY, fields TEXT, primary_key TEXT)")
+
+    # Packages and resources #
+
+    def ensure_package(self, package_id):
+        row = self.connection.execute("SELECT * FROM packages WHERE id = ? OR name = ?", (package_id, package_id)).fetchone()
+        if row is None:
+            with self.connection:
+                self.connection.execute("INSERT INTO packages (id, name, metadata_created) VALUES (?, ?, ?)", (package_id, package_id, now_string()))
+            row = self.connection.execute("SELECT * FROM packages WHERE id = ?", (package_id,)).fetchone()
+        return row
+
+    def resource_dict(self, row):
+        resource = json.loads(row['extras'] or '{}')
+        resource.update({
+            'id': row['id'],
+            'package_id': row['package_id'],
+            'name': row['name'],
+            'url': row['url'],
+            'url_type': row['url_type'],
+            'datastore_active': bool(row['datastore_active']),
+            'position': row['position'],
+            'created': row['created'],
+            'last_modified': row['last_modified'],
+            })
+        return resource
+
+    def get_resource(self, resource_id):
+        row = self.connection.execute("SELECT * FROM resources WHERE id = ?", (resource_id,)).fetchone()
+        if row is None:
+            raise not_found("Resource {} was not found.".format(resource_id))
+        return row
+
+    def package_show(self, data, files):
+        if 'id' not in data:
+            raise validation_error("Missing value: id")
+        package = self.ensure_package(data['id'])
+        rows = self.connection.execute("SELECT * FROM resources WHERE package_id = ? ORDER BY position", (package['id'],)).fetchall()
+        resources = [self.resource_dict(row) for row in rows]
+        return {'id': package['id'], 'name': package['name'], 'metadata_created': package['metadata_created'],
+            'resources': resources, 'num_resources': len(resources)}
+
+    def resource_show(self, data, files):
+        return self.resource_dict(self.get_resource(data.get('id')))
+
+    def save_upload(self, resource_id, files):
+        if 'upload' not in files:
+            return None
+        filename, content = files['upload']
+        filename = os.path.basename(filename or 'upload')
+        upload_dir = os.path.join(self.data_dir, 'uploads', resource_id)
+        if not os.path.exists(upload_dir):
+            os.makedirs(upload_dir)
+        with open(os.path.join(upload_dir, filename), 'wb') as f:
+            f.write(content)
+        return "{}/uploads/{}/{}".format(self.base_url, resource_id, filename)
+
+    def create_resource(self, package_id, name, url='', extras=None, files=None):
+        package = self.ensure_package(package_id)
+        resource_id = str(uuid.uuid4())
+        uploaded_url = self.save_upload(resource_id, files or {})
+        position = self.connection.execute("SELECT COUNT(*) FROM resources WHERE package_id = ?", (package['id'],)).fetchone()[0]
+        with self.connection:
+            self.connection.execute("INSERT INTO resources (id, package_id, name, url, url_type, position, created, last_modified, extras) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (resource_id, package['id'], name, uploaded_url or url,
+                'upload' if uploaded_url else None, position, now_string(), now_string(), json.dumps(extras or {})))
+        return self.get_resource(resource_id)
+
+    def resource_create(self, data, files):
+        if 'package_id' not in data:
+            raise validation_error("Missing value: package_id")
+        extras = {k: v for k, v in data.items() if k not in ['package_id', 'name', 'url', 'upload']}
+        return self.resource_dict(self.create_resource(data['package_id'], data.get('name'), data.get('url', ''), extras, files))
+
+    def resource_update(self, data, files):
+        # Fields that aren't given are kept, which is more lenient than
+        # some CKAN versions but matches how this project calls it.
+        row = self.get_resource(data.get('id'))
+        resource = self.resource_dict(row)
+        resource.update({k: v for k, v in data.items() if k != 'upload'})
+        uploaded_url = self.save_upload(row['id'], files)
+        if uploaded_url is not None:
+            resource['url'] = uploaded_url
+            resource['url_type'] = 'upload'
+        resource['last_modified'] = now_string()
+        core = ['id', 'package_id', 'name', 'url', 'url_type', 'datastore_active', 'position', 'created', 'last_modified']
+        extras = {k: v for k, v in resource.items() if k not in core}
+        with self.connection:
+            self.connection.execute("UPDATE resources SET name = ?, url = ?, url_type = ?, last_modified = ?, extras = ? WHERE id = ?",
+                (resource.get('name'), resource.get('url'), resource.get('url_type'), resource['last_modified'], json.dumps(extras), row['id']))
+        return self.resource_dict(self.get_resource(row['id']))
+
+    def resource_patch(self, data, files):
+        return self.resource_update(data, files)
+
+    def resource_delete(self, data, files):
+        row = self.get_resource(data.get('id'))
+        self.drop_datastore_table(row['id'])
+        with self.connection:
+            self.connection.execute("DELETE FROM resources WHERE id = ?", (row['id'],))
+        return None
+
+    # The datastore #
+
+    def datastore_table(self, resource_id):
+        entry = self.connection.execute("SELECT * FROM datastore_tables WHERE resource_id = ?", (resource_id,)).fetchone()
+        if entry is None:
+            raise not_found("Resource \"{}\" was not found in the datastore.".format(resource_id))
+        return json.loads(entry['fields']), json.loads(entry['primary_key'])
+
+    def drop_datastore_table(self, resource_id):
+        with self.connection:
+            self.connection.execute("DROP TABLE IF EXISTS {}".format(quote(table_name(resource_id))))
+            self.connection.execute("DELETE FROM datastore_tables WHERE resource_id = ?", (resource_id,))
+            self.connection.execute("UPDATE resources SET datastore_active = 0 WHERE id = ?", (resource_id,))
+
+    def datastore_create(self, data, files):
+        if 'resource_id' in data:
+            resource_id = self.get_resource(data['resource_id'])['id']
+        elif 'resource' in data:
+            resource = data['resource']
+            resource_id = self.create_resource(resource.get('package_id'), resource.get('name'), resource.get('url', ''))['id']
+        else:
+            raise validation_error("Missing value: resource_id or resource")
+        fields = data.get('fields', [])
+        primary_key = as_list(data.get('primary_key'))
+        table = quote(table_name(resource_id))
+
+        existing = self.connection.execute("SELECT * FROM datastore_tables WHERE resource_id = ?", (resource_id,)).fetchone()
+        with self.connection:
+            if existing is None:
+                columns = ['"_id" INTEGER PRIMARY KEY AUTOINCREMENT']
+                columns += ["{} {}".format(quote(f['id']), datastore_types.get(f.get('type', 'text'), 'TEXT')) for f in fields]
+                self.connection.execute("CREATE TABLE {} ({})".format(table, ', '.join(columns)))
+            else:
+                known = [f['id'] for f in json.loads(existing['fields'])]
+                for f in fields:
+                    if f['id'] not in known:
+                        self.connection.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, quote(f['id']), datastore_types.get(f.get('type', 'text'), 'TEXT')))
+                if len(primary_key) == 0:
+                    primary_key = json.loads(existing['primary_key'])
+                fields = json.loads(existing['fields']) + [f for f in fields if f['id'] not in known]
+            if len(primary_key) > 0:
+                self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                    quote(table_name(resource_id) + '_pkey'), table, ', '.join(quote(k) for k in primary_key)))
+            self.connection.execute("INSERT OR REPLACE INTO datastore_tables (resource_id, fields, primary_key) VALUES (?, ?, ?)",
+                (resource_id, json.dumps(fields), json.dumps(primary_key)))
+            self.connection.execute("UPDATE resources SET datastore_active = 1 WHERE id = ?", (resource_id,))
+        records = data.get('records') or []
+        if len(records) > 0:
+            self.write_records(resource_id, records, 'upsert' if len(primary_key) > 0 else 'insert')
+        return {'resource_id': resource_id, 'fields': fields, 'primary_key': primary_key, 'method': 'insert'}
+
+    def write_records(self, resource_id, records, method):
+        fields, primary_key = self.datastore_table(resource_id)
+        known = [f['id'] for f in fields]
+        table = quote(table_name(resource_id))
+        if method in ['upsert', 'update'] and len(primary_key) == 0:
+            raise validation_error("The table has no primary key, so it can't be upserted into.")
+        with self.connection:
+            for record in records:
+                unknown = [k for k in record if k not in known and k != '_id']
+                if len(unknown) > 0:
+                    raise validation_error("Fields {} are not in the datastore table.".format(unknown))
+                columns = [k for k in record if k != '_id']
+                values = [record[k] for k in columns]
+                if method == 'update':
+                    key_values = [record.get(k) for k in primary_key]
+                    assignments = ', '.join("{} = ?".format(quote(c)) for c in columns)
+                    conditions = ' AND '.join("{} = ?".format(quote(k)) for k in primary_key)
+                    cursor = self.connection.execute("UPDATE {} SET {} WHERE {}".format(table, assignments, conditions), values + key_values)
+                    if cursor.rowcount == 0:
+                        raise not_found("Key {} was not found.".format(key_values))
+                    continue
+                statement = "INSERT INTO {} ({}) VALUES ({})".format(table, ', '.join(quote(c) for c in columns), ', '.join('?' for c in columns))
+                if method == 'upsert':
+                    updates = [c for c in columns if c not in primary_key]
+                    if len(updates) > 0:
+                        statement += " ON CONFLICT ({}) DO UPDATE SET {}".format(', '.join(quote(k) for k in primary_key),
+                            ', '.join("{} = excluded.{}".format(quote(c), quote(c)) for c in updates))
+                    else:
+                        statement += " ON CONFLICT DO NOTHING"
+                try:
+                    self.connection.execute(statement, values)
+                except sqlite3.IntegrityError as e:
+                    raise validation_error(str(e))
+
+    def datastore_upsert(self, data, files):
+        resource_id = data.get('resource_id')
+        method = data.get('method', 'upsert')
+        if method not in ['upsert', 'insert', 'update']:
+            raise validation_error("Unknown method: {}".format(method))
+        self.write_records(resource_id, data.get('records') or [], method)
+        return {'resource_id': resource_id, 'method': method}
+
+    def datastore_search(self, data, files):
+        resource_id = data.get('resource_id')
+        fields, primary_key = self.datastore_table(resource_id)
+        known = ['_id'] + [f['id'] for f in fields]
+        table = quote(table_name(resource_id))
+        conditions, parameters = [], []
+        filters = data.get('filters') or {}
+        if isinstance(filters, str):
+            filters = json.loads(filters)
+        for k, v in filters.items():
+            if k not in known:
+                raise validation_error("Unknown filter field: {}".format(k))
+            if isinstance(v, list):
+                conditions.append("{} IN ({})".format(quote(k), ', '.join('?' for _ in v)))
+                parameters += v
+            else:
+                conditions.append("{} = ?".format(quote(k)))
+                parameters.append(v)
+        if data.get('q'):
+            text_fields = [f['id'] for f in fields if datastore_types.get(f.get('type', 'text'), 'TEXT') == 'TEXT']
+            if len(text_fields) == 0:
+                conditions.append('0') # With no text columns, nothing can match.
+            else:
+                conditions.append('(' + ' OR '.join("{} LIKE ?".format(quote(f)) for f in text_fields) + ')')
+                parameters += ['%{}%'.format(data['q'])] * len(text_fields)
+        where = " WHERE " + ' AND '.join(conditions) if len(conditions) > 0 else ''
+
+        selected = as_list(data.get('fields')) or known
+        for f in selected:
+            if f not in known:
+                raise validation_error("Unknown field: {}".format(f))
+        order = " ORDER BY _id"
+        if data.get('sort'):
+            terms = []
+            for term in as_list(data['sort']):
+                parts = term.split()
+                if parts[0] not in known:
+                    raise validation_error("Unknown sort field: {}".format(parts[0]))
+                terms.append("{} {}".format(quote(parts[0]), 'DESC' if len(parts) > 1 and parts[1].lower() == 'desc' else 'ASC'))
+            order = " ORDER BY " + ', '.join(terms)
+        limit = int(data.get('limit', 100))
+        offset = int(data.get('offset', 0))
+        total = self.connection.execute("SELECT COUNT(*) FROM {}{}".format(table, where), parameters).fetchone()[0]
+        rows = self.connection.execute("SELECT {} FROM {}{}{} LIMIT ? OFFSET ?".format(', '.join(quote(f) for f in selected), table, where, order),
+            parameters + [limit, offset]).fetchall()
+        return {'resource_id': resource_id,
+            'fields': [{'id': '_id', 'type': 'int'}] + [f for f in fields if f['id'] in selected],
+            'records': [dict(row) for row in rows],
+            'total': total, 'limit': limit, 'offset': offset}
+
+    def datastore_delete(self, data, files):
+        resource_id = data.get('resource_id')
+        fields, primary_key = self.datastore_table(resource_id)
+        filters = data.get('filters')
+        if isinstance(filters, str):
+            filters = json.loads(filters)
+        if not filters:
+            self.drop_datastore_table(resource_id)
+        else:
+            known = ['_id'] + [f['id'] for f in fields]
+            for k in filters:
+                if k not in known:
+                    raise validation_error("Unknown filter field: {}".format(k))
+            conditions = ' AND '.join("{} = ?".format(quote(k)) for k in filters)
+            with self.connection:
+                self.connection.execute("DELETE FROM {} WHERE {}".format(quote(table_name(resource_id)), conditions), list(filters.values()))
+        return {'resource_id': resource_id}
+
+    actions = ['package_show', 'resource_show', 'resource_create', 'resource_update', 'resource_patch', 'resource_delete',
+        'datastore_create', 'datastore_upsert', 'datastore_search', 'datastore_delete']
+
+    def call(self, action, data, files):
+        if action not in self.actions:
+            raise ActionError(400, 'Bad Request', "Action {} is not implemented by the local CKAN stand-in.".format(action))
+        with self.lock:
+            return getattr(self, action)(data, files)
+
+def parse_multipart(content_type, body):
+    message = BytesParser(policy=policy.HTTP).parsebytes(b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+    data, files = {}, {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        filename = part.get_filename()
+        payload = part.get_payload(decode=True)
+        if filename is not None:
+            files[name] = (filename, payload)
+        else:
+            data[name] = payload.decode('utf-8')
+    return data, files
+
+def make_handler(ckan, latency, jitter, error_rate):
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self, status, document):
+            body = json.dumps(document).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json;charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def serve_upload(self, path):
+            file_path = os.path.normpath(os.path.join(ckan.data_dir, unquote(path.lstrip('/'))))
+            if not file_path.startswith(os.path.join(ckan.data_dir, 'uploads')) or not os.path.isfile(file_path):
+                self.respond(404, {'success': False, 'error': {'__type': 'Not Found Error', 'message': 'Not found'}})
+                return
+            with open(file_path, 'rb') as f:
+                content = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def handle_action(self, data, files):
+            path = urlparse(self.path).path
+            match = re.match(r'^/api/(?:3/)?action/(\w+)$', path)
+            if match is None:
+                self.respond(404, {'success': False, 'error': {'__type': 'Not Found Error', 'message': 'Not found'}})
+                return
+            action = match.group(1)
+            # Injected latency and errors, to see how the ETL copes with a
+            # slow or flaky CKAN.
+            if latency > 0 or jitter > 0:
+                time.sleep(max(0.0, random.gauss(latency, jitter)))
+            if error_rate > 0 and random.random() < error_rate:
+                self.respond(503, {'success': False, 'error': {'__type': 'Internal Server Error', 'message': 'Injected error'}})
+                return
+            try:
+                result = ckan.call(action, data, files)
+            except ActionError as e:
+                self.respond(e.status, {'help': action, 'success': False, 'error': {'__type': e.error_type, 'message': e.message}})
+                return
+            except (ValueError, KeyError, TypeError, sqlite3.IntegrityError) as e:
+                # Malformed parameters (a field without an id, a limit that
+                # isn't a number, a duplicate key, ...), which real CKAN
+                # reports as validation errors.
+                self.respond(409, {'help': action, 'success': False, 'error': {'__type': 'Validation Error',
+                    'message': "{}: {}".format(type(e).__name__, e)}})
+                return
+            except Exception as e:
+                traceback.print_exc()
+                self.respond(500, {'help': action, 'success': False, 'error': {'__type': 'Internal Server Error',
+                    'message': "{}: {}".format(type(e).__name__, e)}})
+                return
+            self.respond(200, {'help': action, 'success': True, 'result': result})
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            if parsed.path.startswith('/uploads/'):
+                self.serve_upload(parsed.path)
+                return
+            data = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            self.handle_action(data, {})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            content_type = self.headers.get('Content-Type', '')
+            try:
+                if content_type.startswith('multipart/form-data'):
+                    data, files = parse_multipart(content_type, body)
+                elif content_type.startswith('application/x-www-form-urlencoded'):
+                    data, files = {k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()}, {}
+                else:
+                    data, files = (json.loads(body.decode('utf-8')) if len(body) > 0 else {}), {}
+            except ValueError as e:
+                self.respond(400, {'success': False, 'error': {'__type': 'Bad Request', 'message': str(e)}})
+                return
+            self.handle_action(data, files)
+
+        def log_message(self, format, *args):
+            sys.stderr.write("[local CKAN] {}\n".format(format % args))
+
+    return Handler
+
+def serve(port=5050, data_dir=None, latency=0.0, jitter=0.0, error_rate=0.0, host='localhost'):
+    if data_dir is None:
+        data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'local_ckan_data')
+    ckan = LocalCKAN(data_dir, "http://{}:{}".format(host, port))
+    server = ThreadingHTTPServer((host, port), make_handler(ckan, latency, jitter, error_rate))
+    print("Local CKAN stand-in listening on http://{}:{} (data in {})".format(host, port, data_dir))
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local, SQLite-backed stand-in for CKAN.')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--data-dir', default=None, help='Where to keep the SQLite database and uploaded files')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean latency (in seconds) to add to every action call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation (in seconds) of the added latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of action calls that fail with a 503')
+    args = parser.parse_args()
+    server = serve(args.port, args.data_dir, args.latency, args.jitter, args.error_rate, args.host)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,110 @@
+import os, json, time, fcntl, socket
+from datetime import datetime
+
+from publishing import slugify, ensure_directory
+
+# Single-flight coordination of ETL runs.
+#
+# A cycle can run longer than the polling interval (page rendering, a slow
+# upsert, a big XML upload), in which case cron starts the next one anyway
+# and both would download the same files, both would see is_changed()
+# return True, and both would upsert the same rows. To prevent that, each
+# run takes an exclusive lock per (server, election) before doing any
+# work. A second invocation then either exits at once or waits for the
+# first run to finish and reuses its result.
+#
+# The locks are flock() locks, which the operating system releases when
+# the holding process dies, so a crashed run can never leave a lock
+# behind. A companion .holder file records who holds the lock and since when;
+# a lock that has been held for longer than stale_after seconds belongs
+# to a run that is probably hung, and that is reported to the admins.
+
+default_lock_settings = {
+    'wait': False, # Whether a second invocation waits for the first one to finish
+    'wait_timeout': 900, # seconds
+    'stale_after': 1800, # seconds
+    }
+
+class RunLock(object):
+    def __init__(self, lock_file, result_file, handle):
+        self.lock_file = lock_file
+        self.result_file = result_file
+        self.handle = handle
+
+def lock_paths(lock_dir, server, election):
+    base = "{}/{}-{}".format(ensure_directory(lock_dir), server, slugify(election))
+    return base + '.lock', base + '.result.json'
+
+def try_lock(handle):
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except (BlockingIOError, PermissionError):
+        return False
+
+def read_json(file_path):
+    try:
+        with open(file_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_json(file_path, document):
+    temp_file = file_path + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(document, f)
+    os.replace(temp_file, file_path)
+
+def report_holder(lock_file, stale_after, notify=None):
+    holder = read_json(lock_file + '.holder')
+    if holder is None:
+        print("Another run holds {}.".format(lock_file))
+        return
+    age = time.time() - holder['acquired_at']
+    print("Another run (PID {} on {}) has held {} for {:.0f} seconds.".format(holder['pid'], holder['hostname'], lock_file, age))
+    if age > stale_after and notify is not None:
+        notify("The countermeasures run with PID {} on {} has held the lock {} for {:.0f} seconds and may be hung.".format(holder['pid'], holder['hostname'], lock_file, age))
+
+def acquire_run_lock(lock_dir, server, election, settings=None, notify=None):
+    # Returns a RunLock if this invocation should go ahead with the cycle.
+    # Returns None if it should stop, either because another run is in
+    # progress (and we aren't waiting) or because we waited and another
+    # run has just finished the same work.
+    config = dict(default_lock_settings)
+    config.update(settings or {})
+    lock_file, result_file = lock_paths(lock_dir, server, election)
+    handle = open(lock_file, 'a')
+
+    if not try_lock(handle):
+        report_holder(lock_file, config['stale_after'], notify)
+        if not config['wait']:
+            handle.close()
+            print("Exiting to avoid duplicating that run's work.")
+            return None
+        waiting_since = time.time()
+        while not try_lock(handle):
+            if time.time() - waiting_since > config['wait_timeout']:
+                handle.close()
+                report_holder(lock_file, config['stale_after'], notify)
+                print("Gave up waiting for the other run after {} seconds.".format(config['wait_timeout']))
+                return None
+            time.sleep(1.0)
+        result = read_json(result_file)
+        if result is not None and result['finished_at'] >= waiting_since and result['outcome'] != 'failed':
+            fcntl.flock(handle, fcntl.LOCK_UN)
+            handle.close()
+            print("Reusing the result of the run that just finished ({}).".format(result['outcome']))
+            return None
+
+    write_json(lock_file + '.holder', dict(pid=os.getpid(), hostname=socket.gethostname(), acquired_at=time.time(),
+        acquired=datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    return RunLock(lock_file, result_file, handle)
+
+def release_run_lock(lock, outcome=None):
+    # The outcome ('published', 'unchanged' or 'failed') is saved so that a
+    # waiting invocation can reuse it. Runs that don't publish (like
+    # prepare) pass no outcome, so that a waiting cycle goes ahead.
+    if outcome is not None:
+        write_json(lock.result_file, dict(outcome=outcome, finished_at=time.time()))
+    fcntl.flock(lock.handle, fcntl.LOCK_UN)
+    lock.handle.close()
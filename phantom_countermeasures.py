@@ -9,12 +9,25 @@ import time
 from datetime import datetime, timedelta
 import dataset
 from zipfile import PyZipFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 from lxml import html, etree # Use etree.tostring(element) to dump 
 # the raw XML.
 
 from notify import send_to_slack
+from detail_xml import iter_precinct_votes
+from columnar import write_columnar_exports, publish_columnar_exports
+from discovery import discover_report_urls, discover_with_fallbacks, DiscoveryError
+from locking import acquire_run_lock, release_run_lock
+from precinct_deltas import publish_precinct_deltas, save_snapshot
+from profiling import stage, run_with_profile, is_profiling
+from jurisdictions import default_jurisdiction, jurisdiction_state_dir, package_for
+from latency import record_sighting, record_publish_latency
+from warmup import prepared_resource_ids, prepare_resources
+from priority import priority_contests, split_summary_csv, record_priority_batch
+from cache_server import feed_cache
+from aggregates import load_summary_rows, update_contest_aggregates, save_contest_aggregates, publish_contest_aggregates
 
 from parameters.local_parameters import ELECTION_RESULTS_SETTINGS_FILE, PHANTOMJSCLOUD_API_KEY
 import ckanapi
@@ -238,47 +251,177 @@ def update_hash(db, table, zip_file, r_name, file_mod_date):
     table = save_new_hash(db, table, hash_value, r_name, file_mod_date)
     return
 
-def main(schema, **kwparams):
+def discover_with_phantomjscloud(url, timeout=90):
+    # The page is server-side generated, so one must use something like
+    # Selenium (or a cloud web-scraper) to find out what the download link is.
+    data = { "url": url, "renderType": "html" }
+    phantom_url = f'http://PhantomJScloud.com/api/browser/v2/{PHANTOMJSCLOUD_API_KEY}/' #a-demo-key-with-low-quota-per-ip-address/
+    req = requests.post(phantom_url, data=json.dumps(data), timeout=timeout)
+    tree = html.fromstring(req.content)
+
+    summary_file_url = tree.xpath("//a[starts-with(@aria-label, 'Download Summary CSV')]")[0].attrib['href'] # 'https://results.enr.clarityelections.com//PA/Allegheny/112982/289202/reports/summary.zip'
+    xml_file_url = tree.xpath("//a[starts-with(@aria-label, 'Download Detail XML')]")[0].attrib['href'] # 'https://results.enr.clarityelections.com//PA/Allegheny/112982/289202/reports/detailxml.zip'
+    return summary_file_url, xml_file_url
+
+def scrape_landing_page(jurisdiction):
+    # Returns the name of the most recent election and the URL of its
+    # Clarity page.
     # Scrape location of zip file (and designation of the election):
-    r = requests.get("http://www.alleghenycounty.us/elections/election-results.aspx")
-    tree = html.fromstring(r.content)
+    with stage('landing page'):
+        r = requests.get(jurisdiction['landing_url'], verify=jurisdiction.get('verify', True))
+        tree = html.fromstring(r.content)
     #title_kodos = tree.xpath('//div[@class="custom-form-table"]/table/tbody/tr[1]/td[2]/a/@title')[0] # Xpath to find the title for the link
     # As the title is human-generated, it can differ from the actual text shown on the web page.
     # In one instance, the title was '2019 Primary', while the link text was '2019 General'.
-    election_index = 1 # Manually increment this to re-pull older elections
-    title_kodos = tree.xpath('//table/tbody/tr[{}]/td[2]/a/text()'.format(election_index))[0] # Xpath to find the text for the link
+    election_index = jurisdiction['election_index'] # Increment this to re-pull older elections
+    title_kodos = tree.xpath(jurisdiction['title_xpath'].format(election_index))[0] # Xpath to find the text for the link
     ## to the MOST RECENT election (e.g., "2017 General Election").
+    # Counties other than Allegheny get a prefix (e.g., "Butler County ") so
+    # that their resource names can't collide with Allegheny's.
+    title_kodos = jurisdiction['resource_name_prefix'] + title_kodos
 
-    url = tree.xpath('//table/tbody/tr[{}]/td[2]/a'.format(election_index))[0].attrib['href']
+    url = tree.xpath(jurisdiction['link_xpath'].format(election_index))[0].attrib['href']
     # But this looks like this:
     #   'http://results.enr.clarityelections.com/PA/Allegheny/71801/Web02/#/'
     # so it still doesn't get us that other 6-digit number needed for the
     # full path, leaving us to scrape that too, and it turns out that 
     # such scraping is necessary since the directory where the zipped CSV
     # files are found changes too.
+    return title_kodos, url
+
+def main(schema, **kwparams):
+    # The county to scrape is described by a jurisdiction (see
+    # jurisdictions.py). By default, it's Allegheny County.
+    jurisdiction = dict(default_jurisdiction)
+    jurisdiction.update(kwparams.get('jurisdiction', {}))
+    state_dir = jurisdiction_state_dir(dname, jurisdiction)
+
+    title_kodos, url = scrape_landing_page(jurisdiction)
 
-    path = dname + "/tmp"
+    path = state_dir + "/tmp"
     # If this path doesn't exist, create it.
     if not os.path.exists(path):
         os.makedirs(path)
 
-    # Worse than that, the page is server-side generated, so one must
-    # use something like Selenium (or a cloud web-scraper) to find out what the download link is.
+    # with open(os.path.dirname(os.path.abspath(__file__))+'/ckan_settings.json') as f: # The path of this file needs to be specified.
+    with open(ELECTION_RESULTS_SETTINGS_FILE) as f: 
+        settings = json.load(f)
 
-    data = { "url": url, "renderType": "html" }
-    phantom_url = f'http://PhantomJScloud.com/api/browser/v2/{PHANTOMJSCLOUD_API_KEY}/' #a-demo-key-with-low-quota-per-ip-address/
-    req = requests.post(phantom_url, data=json.dumps(data))
-    tree = html.fromstring(req.content)
+    # One invocation can publish to several targets (servers in the 'loader'
+    # section of the settings file), all from a single download.
+    servers = kwparams.get('servers', [kwparams.get('server', "test")])
+    if servers == ['all']:
+        servers = sorted(settings['loader'].keys())
+
+    # Only one run at a time per (server, election). If another run is in
+    # progress, either exit right away or wait for it and reuse its result.
+    # The locks are always taken in sorted order, so that two waiting runs
+    # with overlapping servers can't each hold a lock the other wants.
+    locks = {}
+    for server in sorted(set(servers)):
+        lock = acquire_run_lock(state_dir + '/locks', server, title_kodos, settings.get('run_lock', {}), notify=notify_admins)
+        if lock is not None:
+            locks[server] = lock
+    if len(locks) == 0:
+        return
+    outcomes = {}
+    try:
+        outcomes = process_election(schema, title_kodos, url, path, settings, sorted(locks.keys()), jurisdiction, state_dir)
+    finally:
+        for server, lock in locks.items():
+            release_run_lock(lock, outcomes.get(server, 'failed'))
+    return outcomes
+
+def prepare(schema, **kwparams):
+    # Pre-election warm-up (run with 'prepare' as the first argument).
+    # Once the County has posted the election's page, this does the setup
+    # that the first cycle with real results would otherwise do inline:
+    # URL discovery, name resolution, and the creation of every resource
+    # that a cycle publishes to (the results, per-contest and per-precinct
+    # datastore tables, the zipped XML file, the JSON feeds and the
+    # columnar exports), whose IDs are cached so that election night
+    # doesn't have to look up or create any resources.
+    jurisdiction = dict(default_jurisdiction)
+    jurisdiction.update(kwparams.get('jurisdiction', {}))
+    state_dir = jurisdiction_state_dir(dname, jurisdiction)
+    title_kodos, url = scrape_landing_page(jurisdiction)
+
+    path = state_dir + "/tmp"
+    if not os.path.exists(path):
+        os.makedirs(path)
 
-    summary_file_url = tree.xpath("//a[starts-with(@aria-label, 'Download Summary CSV')]")[0].attrib['href'] # 'https://results.enr.clarityelections.com//PA/Allegheny/112982/289202/reports/summary.zip'
+    with open(ELECTION_RESULTS_SETTINGS_FILE) as f: 
+        settings = json.load(f)
+    servers = kwparams.get('servers', [kwparams.get('server', "test")])
+    if servers == ['all']:
+        servers = sorted(settings['loader'].keys())
+
+    # Running discovery now checks that the election's Clarity page is up
+    # (and starts the latency history that hedging uses).
+    try:
+        summary_file_url, xml_file_url, backend_name = discover_download_links(url, path, settings, state_dir)
+        print("The {} discovery backend found {} and {}.".format(backend_name, summary_file_url, xml_file_url))
+    except DiscoveryError as e:
+        print("Discovery doesn't work yet ({}). It will be tried again on every cycle.".format(e))
+
+    r_chosen_name = title_kodos # Using the scraped name seems better.
+
+    # prepare takes the same per-(server, election) lock as a cycle, so it
+    # never creates resources while a cycle is publishing to them.
+    for server in sorted(set(servers)):
+        lock = acquire_run_lock(state_dir + '/locks', server, title_kodos, settings.get('run_lock', {}), notify=notify_admins)
+        if lock is None:
+            print("Skipped preparing {} on {}.".format(r_chosen_name, server))
+            continue
+        try:
+            db = dataset.connect('sqlite:///{}/hashes-{}.db'.format(state_dir, server))
+            site = settings['loader'][server]['ckan_root_url']
+            package_id = package_for(jurisdiction, server, settings)
+            API_key = settings['loader'][server]['ckan_api_key']
+            prepared = prepare_resources(site, package_id, API_key, db, r_chosen_name, fields_to_publish, ['line_number'], r_chosen_name + ' by Precinct (zipped XML file)', arrow=settings.get('arrow_exports', False))
+            print("Prepared {} on {}: {}".format(r_chosen_name, server, prepared))
+        finally:
+            release_run_lock(lock)
+
+def discover_download_links(url, path, settings, state_dir):
+    # Returns the summary file URL, the XML file URL and the name of the
+    # backend that found them, or raises a DiscoveryError.
+    # Clarity publishes the current report version through static
+    # endpoints, so first try to build the download URLs with plain HTTP
+    # requests. Only if that fails (or times out, or has been failing
+    # lately), fall back to rendering the page. The order, timeouts,
+    # circuit-breaker and hedging settings can be overridden under the
+    # 'discovery' key of the settings file, where clarity_root_url (e.g.,
+    # 'http://localhost:8000') points the Clarity backend at a local stub.
+    discovery_settings = settings.get('discovery', {})
+    timeouts = discovery_settings.get('timeouts', {})
+    clarity_timeout, phantomjscloud_timeout = timeouts.get('clarity', 30), timeouts.get('phantomjscloud', 90)
+    backends = [
+        {'name': 'clarity', 'function': lambda u: discover_report_urls(u, timeout=clarity_timeout, root_url=discovery_settings.get('clarity_root_url')), 'timeout': clarity_timeout},
+        {'name': 'phantomjscloud', 'function': lambda u: discover_with_phantomjscloud(u, timeout=phantomjscloud_timeout), 'timeout': phantomjscloud_timeout},
+        ]
+    if 'order' in discovery_settings:
+        backends = [b for name in discovery_settings['order'] for b in backends if b['name'] == name]
+    discovery_db = dataset.connect('sqlite:///{}/discovery.db'.format(state_dir))
+    return discover_with_fallbacks(url, backends, discovery_db, discovery_settings)
+
+def process_election(schema, title_kodos, url, path, settings, servers, jurisdiction, state_dir):
+    with stage('discovery'):
+        try:
+            summary_file_url, xml_file_url, backend_name = discover_download_links(url, path, settings, state_dir)
+        except DiscoveryError as e:
+            notify_admins("Scraping Failure: Unable to find the download links ({}). Countermeasures terminated.".format(e))
+            raise ValueError("This ETL job is broken on account of scraping failure.")
+    print("Download links found by the {} discovery backend.".format(backend_name))
 
     # Download ZIP file
     #election_type = "Primary"
     #r = requests.get("http://results.enr.clarityelections.com/PA/Allegheny/68994/188052/reports/summary.zip") # 2017 Primary Election file URL
 
     election_type = "General"
-    r = requests.get(summary_file_url) # 2017 General Election file URL
-    xml_file_url = tree.xpath("//a[starts-with(@aria-label, 'Download Detail XML')]")[0].attrib['href'] # 'https://results.enr.clarityelections.com//PA/Allegheny/112982/289202/reports/detailxml.zip'
+    with stage('download summary'):
+        r = requests.get(summary_file_url) # 2017 General Election file URL
+    polled_at = time.time()
 
     found = True
     if re.search("xml", xml_file_url) is None:
@@ -290,71 +433,150 @@ def main(schema, **kwparams):
         raise ValueError("This ETL job is broken on account of scraping failure.")
 
     # Save result from requests to zip_file location.
-    zip_file = dname + '/tmp/summary.zip'
+    zip_file = state_dir + '/tmp/summary.zip'
     with open(format(zip_file), 'wb') as f:
         f.write(r.content)
 
     print("zip_file = {}".format(zip_file))
     today = datetime.now()
 
+    # Work out which targets need this file before doing anything else.
     # Make name of hash database dependent on the server
     # as a very clear way of differentiating test and production
-    # datasets.
-    server = kwparams.get('server', "test")
-    db = dataset.connect('sqlite:///{}/hashes-{}.db'.format(dname, server))
-    table = db['election']
-
-    # with open(os.path.dirname(os.path.abspath(__file__))+'/ckan_settings.json') as f: # The path of this file needs to be specified.
-    with open(ELECTION_RESULTS_SETTINGS_FILE) as f: 
-        settings = json.load(f)
-    site = settings['loader'][server]['ckan_root_url']
-    package_id = settings['loader'][server]['package_id']
-    API_key = settings['loader'][server]['ckan_api_key']
-
+    # datasets. Each target keeps its own change state.
+    outcomes = {}
+    changed_servers = []
+    for server in servers:
+        db = dataset.connect('sqlite:///{}/hashes-{}.db'.format(state_dir, server))
+        table = db['election']
+        with stage('hashing'):
+            changed, last_hash_entry, last_modified = is_changed(table, zip_file, title_kodos)
+        if not changed:
+            print("The Election Results summary file for {} seems to be unchanged on {}.".format(title_kodos, server))
+            outcomes[server] = 'unchanged'
+        else:
+            print("The Election Results summary file for {} does not match a previous file on {}.".format(title_kodos, server))
+            changed_servers.append(server)
+            # Remember when this version of the file was first seen, for
+            # measuring the detection lag.
+            record_sighting(db, title_kodos, compute_hash(zip_file), polled_at)
+    if len(changed_servers) == 0:
+        return outcomes
+
+    election_type = None # Change this to force a particular election_type to be used, but it's
+    # basically irrelevant since r_name_kang is not being used.
+    r_name_kang = build_resource_name(today, last_modified, election_type)
+    #r_name_kodos = re.sub(" Results"," Election Results",title_kodos)
+    # Sample names from titles of links:
+    # Special Election for 35th Legislative District
+    # 2017 General Results
+    # Election Results: 2014 Primary
+    # Election Results: 2014 General Election
+    # 2012 Special 40th State Sen Results
+    
+    # Since there's so much variation in these names, maybe it's best just
+    # to use them without modifying them and accept that the resource 
+    # names will vary a little. They can always be cleaned up after the election.
+    r_name_kodos = title_kodos
 
-    changed, last_hash_entry, last_modified = is_changed(table, zip_file, title_kodos)
-    if not changed:
-        print("The Election Results summary file for {} seems to be unchanged.".format(title_kodos))
-        return
-    else:
-        print("The Election Results summary file for {} does not match a previous file.".format(title_kodos))
-        election_type = None # Change this to force a particular election_type to be used, but it's
-        # basically irrelevant since r_name_kang is not being used.
-        r_name_kang = build_resource_name(today, last_modified, election_type)
-        #r_name_kodos = re.sub(" Results"," Election Results",title_kodos)
-        # Sample names from titles of links:
-        # Special Election for 35th Legislative District
-        # 2017 General Results
-        # Election Results: 2014 Primary
-        # Election Results: 2014 General Election
-        # 2012 Special 40th State Sen Results
-        
-        # Since there's so much variation in these names, maybe it's best just
-        # to use them without modifying them and accept that the resource 
-        # names will vary a little. They can always be cleaned up after the election.
-        r_name_kodos = title_kodos
-
-        print("Inferred name = {}, while scraped name = {}".format(r_name_kang, r_name_kodos))
-       
-        r_chosen_name = r_name_kodos # Using the scraped name seems better.
-
-        if r_name_kang != r_name_kodos:
-            resource_id = find_resource_id(site, package_id, r_chosen_name, API_key=API_key)
-            if resource_id is None:
-                send_to_slack("countermeasures has found two conflicting names for the resource: {} and {}. Neither can be found in the dataset. {} is being used as the default.\nThis is your reminder to move the new resources to the top of the list.".format(r_name_kodos, r_name_kang, r_name_kodos), username='countermeasures', channel='@david', icon=':satellite_antenna:')
-                # The first time this notification fired, the Kodos name was "Special Election for 35th Legislative District" and the Kang name was "2018 General Election Results".
-                # The second name was (incorrectly) used for storing the CSV file, while the first name was used for storing the zipped XML file.
+    print("Inferred name = {}, while scraped name = {}".format(r_name_kang, r_name_kodos))
+   
+    r_chosen_name = r_name_kodos # Using the scraped name seems better.
 
     # Unzip the file
     filename = "summary.csv"
     zf = PyZipFile(zip_file).extract(filename, path=path)
     target = "{}/{}".format(path, filename)
     print("target = {}".format(target))
-    specify_resource_by_name = True
+
+    # Everything that doesn't depend on the target is done once: validating
+    # the rows, downloading the zipped XML file, and writing the exports.
+    with stage('validation'):
+        rows = load_summary_rows(schema, target, encoding=jurisdiction.get('encoding', 'utf-8'))
+
+    with stage('download detail xml'):
+        r_xml = requests.get(xml_file_url)
+        xml_file = state_dir + '/tmp/detailxml.zip'
+        with open(format(xml_file), 'wb') as g:
+            g.write(r_xml.content)
+
+    # Write typed Parquet (and optionally Arrow IPC) exports of the
+    # validated summary rows and the precinct-level detail, so that the
+    # whole election can be fetched as one compressed columnar file.
+    with stage('columnar exports'):
+        exports = write_columnar_exports(schema, rows, fields_to_publish, iter_precinct_votes(xml_file), state_dir + '/public', r_chosen_name, arrow=settings.get('arrow_exports', False))
+
+    # Publish to all the targets that need it at the same time. A failure
+    # on one target is reported but doesn't stop the others.
+    with stage('publishing'):
+        publish_args = (settings, jurisdiction, state_dir, r_chosen_name, r_name_kang, target, zip_file, xml_file, rows, exports, last_modified)
+        if is_profiling():
+            # The profiler only follows the main thread, so under --profile
+            # the targets are published one after another.
+            for server in changed_servers:
+                outcomes[server] = publish_or_fail(schema, server, *publish_args)
+        else:
+            with ThreadPoolExecutor(max_workers=len(changed_servers)) as executor:
+                futures = {executor.submit(publish_or_fail, schema, server, *publish_args): server for server in changed_servers}
+                for future in as_completed(futures):
+                    outcomes[futures[future]] = future.result()
+
+    published = [server for server in changed_servers if outcomes[server] == 'published']
+    # Feed the optional read-through cache (see cache_server.py), which
+    # serves the latest results without touching CKAN.
+    if len(published) > 0:
+        feed_cache(settings, schema, r_chosen_name, rows)
+    log = open(state_dir + '/uploaded.log', 'w+')
+    print("Piped data to {} on {}".format(r_chosen_name, published))
+    log.write("Finished upserting {} to {}\n".format(r_chosen_name, ', '.join(published)))
+    log.close()
+
+    
+    # Delete temp file after extraction.
+    delete_temporary_file(zip_file)
+    delete_temporary_file(path + '/' + filename)
+    return outcomes
+
+def publish_or_fail(schema, server, settings, jurisdiction, state_dir, r_chosen_name, *args):
+    # Returns the outcome of publishing to one target. A failure is
+    # reported to the admins instead of being raised.
+    try:
+        return publish_to_target(schema, server, settings, jurisdiction, state_dir, r_chosen_name, *args)
+    except Exception:
+        traceback_msg = traceback.format_exc()
+        print(traceback_msg)
+        notify_admins("countermeasures was unable to publish {} to {}:\n{}".format(r_chosen_name, server, traceback_msg))
+        return 'failed'
+
+def publish_to_target(schema, server, settings, jurisdiction, state_dir, r_chosen_name, r_name_kang, target, zip_file, xml_file, rows, exports, last_modified):
+    # Publishes one (already downloaded and validated) set of results to
+    # one server. This runs in its own thread, one per target (except
+    # under --profile).
+    db = dataset.connect('sqlite:///{}/hashes-{}.db'.format(state_dir, server))
+    table = db['election']
+    site = settings['loader'][server]['ckan_root_url']
+    package_id = package_for(jurisdiction, server, settings)
+    API_key = settings['loader'][server]['ckan_api_key']
+    r_name_kodos = r_chosen_name
+
+    # Resources created ahead of time by prepare() are addressed by their
+    # cached IDs, which skips the package_show lookups.
+    prepared = prepared_resource_ids(db, r_chosen_name)
+
+    if r_name_kang != r_name_kodos and r_chosen_name not in prepared:
+        resource_id = find_resource_id(site, package_id, r_chosen_name, API_key=API_key)
+        if resource_id is None:
+            send_to_slack("countermeasures has found two conflicting names for the resource: {} and {}. Neither can be found in the dataset. {} is being used as the default.\nThis is your reminder to move the new resources to the top of the list.".format(r_name_kodos, r_name_kang, r_name_kodos), username='countermeasures', channel='@david', icon=':satellite_antenna:')
+            # The first time this notification fired, the Kodos name was "Special Election for 35th Legislative District" and the Kang name was "2018 General Election Results".
+            # The second name was (incorrectly) used for storing the CSV file, while the first name was used for storing the zipped XML file.
+
+    specify_resource_by_name = r_chosen_name not in prepared
     if specify_resource_by_name:
         kwargs = {'resource_name': r_chosen_name}
-    #else:
-        #kwargs = {'resource_id': ''}
+    else:
+        kwargs = {'resource_id': prepared[r_chosen_name]}
+    if server in jurisdiction['packages']:
+        kwargs['package_id'] = package_id
 
     # Code below stolen from prime_ckan/*/open_a_channel() but really 
     # from utility_belt/gadgets 
@@ -363,65 +585,97 @@ def main(schema, **kwparams):
     print("Preparing to pipe data from {} to resource {} (package ID = {}) on {}".format(target, list(kwargs.values())[0], package_id, site))
     time.sleep(1.0)
 
-    pipeline = pl.Pipeline('election_results_pipeline',
-                              'Pipeline for the County Election Results',
-                              log_status=False,
-                              settings_file=ELECTION_RESULTS_SETTINGS_FILE,
-                              settings_from_file=True,
-                              start_from_chunk=0
-                              ) \
-        .connect(pl.FileConnector, target, encoding='utf-8') \
-        .extract(pl.CSVExtractor, firstline_headers=True) \
-        .schema(schema) \
-        .load(pl.CKANDatastoreLoader, server,
-              fields=fields_to_publish,
-              #package_id=package_id,
-              #resource_id=resource_id,
-              #resource_name=resource_name,
-              key_fields=['line_number'],
-              method='upsert',
-              **kwargs).run()
-
+    # Commit the headline contests first (see priority.py), so that they
+    # don't wait behind hundreds of down-ballot rows.
+    encoding = jurisdiction.get('encoding', 'utf-8')
+    contests = priority_contests(db, r_chosen_name, rows, settings.get('priority', {}))
+    batches = split_summary_csv(target, encoding, contests, server)
+    publish_start = time.time()
+
+    with stage('pipeline upsert'):
+        for k, batch in enumerate(batches):
+            pipeline = pl.Pipeline('election_results_pipeline',
+                                      'Pipeline for the County Election Results',
+                                      log_status=False,
+                                      settings_file=ELECTION_RESULTS_SETTINGS_FILE,
+                                      settings_from_file=True,
+                                      start_from_chunk=0
+                                      ) \
+                .connect(pl.FileConnector, batch, encoding=encoding) \
+                .extract(pl.CSVExtractor, firstline_headers=True) \
+                .schema(schema) \
+                .load(pl.CKANDatastoreLoader, server,
+                      fields=fields_to_publish,
+                      #package_id=package_id,
+                      #resource_id=resource_id,
+                      #resource_name=resource_name,
+                      key_fields=['line_number'],
+                      method='upsert',
+                      **kwargs).run()
+            if k == 0 and len(batches) > 1:
+                record_priority_batch(db, r_chosen_name, contests, publish_start, last_modified)
+    published_at = time.time()
+    for batch in batches:
+        if batch != target:
+            delete_temporary_file(batch)
     
-    update_hash(db, table, zip_file, r_chosen_name, last_modified)
-
-    # Also update the zipped XML file.
+    # Compute the per-contest aggregates (leader, margin, turnout, precincts
+    # reporting) for the contests that changed and publish them as a small
+    # separate resource and a static JSON file.
+    with stage('aggregates'):
+        aggregates, changed_contests, digests = update_contest_aggregates(db, r_chosen_name, rows)
+        publish_contest_aggregates(site, package_id, API_key, r_chosen_name, aggregates, changed_contests, state_dir + '/public/' + server, resource_ids=prepared)
+        save_contest_aggregates(db, r_chosen_name, changed_contests, digests)
+
+    # Diff the precinct-level detail against the last snapshot and publish
+    # only the rows that changed (plus the newly reporting precincts).
+    # If no row changed or was removed, there's no need to re-upload the
+    # zipped XML file.
+    with stage('precinct deltas'):
+        changed_precinct_rows, precinct_snapshot = publish_precinct_deltas(site, package_id, API_key, server, r_chosen_name, xml_file, state_dir + '/tmp', state_dir + '/public/' + server, resource_ids=prepared)
+    if changed_precinct_rows > 0:
+        xml_name = r_chosen_name+' by Precinct (zipped XML file)'
 
-    r_xml = requests.get(xml_file_url)
-    xml_file = dname + '/tmp/detailxml.zip'
-    with open(format(xml_file), 'wb') as g:
-        g.write(r_xml.content)
+        ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
+        resource_id = prepared.get(xml_name)
+        if resource_id is None:
+            resource_id = find_resource_id(site, package_id, xml_name, API_key=API_key)
+        if resource_id is None:
+            ckan.action.resource_create(
+                package_id=package_id,
+                url='dummy-value',  # ignored but required by CKAN<2.6
+                name=xml_name,
+                upload=open(xml_file, 'rb'))
+        else:
+            ckan.action.resource_update(
+                package_id=package_id,
+                url='dummy-value',  # ignored but required by CKAN<2.6
+                id = resource_id,
+                upload=open(xml_file, 'rb'))
+
+    # Only now that the zipped XML file is up too are the precinct
+    # changes recorded as published. If the upload failed, they're found
+    # (and the file is uploaded) again next cycle.
+    if precinct_snapshot is not None:
+        save_snapshot(precinct_snapshot, state_dir + '/tmp', server, r_chosen_name)
+
+    with stage('uploading exports'):
+        publish_columnar_exports(site, package_id, API_key, exports, resource_ids=prepared)
+
+    # Only now that every upload has succeeded is this version of the
+    # file recorded as published to this target. If any step above
+    # fails, the next cycle sees the file as changed and tries again.
+    update_hash(db, table, zip_file, r_chosen_name, last_modified)
 
-    xml_name = r_chosen_name+' by Precinct (zipped XML file)'
+    # Track the lag from the county publishing the file to our datastore
+    # publishing it (and alert if it's over the SLO in the settings).
+    record_publish_latency(db, r_chosen_name, compute_hash(zip_file), last_modified, published_at, settings.get('latency', {}), notify=notify_admins)
 
-    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-    resource_id = find_resource_id(site, package_id, xml_name, API_key=API_key)
-    if resource_id is None:
-        ckan.action.resource_create(
-            package_id=package_id,
-            url='dummy-value',  # ignored but required by CKAN<2.6
-            name=xml_name,
-            upload=open(xml_file, 'rb'))
-    else:
-        ckan.action.resource_update(
-            package_id=package_id,
-            url='dummy-value',  # ignored but required by CKAN<2.6
-            id = resource_id,
-            upload=open(xml_file, 'rb'))
-
-    log = open(dname + '/uploaded.log', 'w+')
     if specify_resource_by_name:
-        print("Piped data to {}".format(kwargs['resource_name']))
-        log.write("Finished upserting {}\n".format(kwargs['resource_name']))
+        print("Piped data to {} on {}".format(kwargs['resource_name'], server))
     else:
-        print("Piped data to {}".format(kwargs['resource_id']))
-        log.write("Finished upserting {}\n".format(kwargs['resource_id']))
-    log.close()
-
-    
-    # Delete temp file after extraction.
-    delete_temporary_file(zip_file)
-    delete_temporary_file(path + '/' + filename)
+        print("Piped data to {} on {}".format(kwargs['resource_id'], server))
+    return 'published'
 
 
 schema = ElectionResultsSchema
@@ -435,21 +689,33 @@ print("fields_to_publish = {}".format(fields_to_publish))
 
 if __name__ == "__main__":
     # stuff only to run when not called via 'import' here
+    # Passing --profile (anywhere on the command line) runs main() under
+    # cProfile and tracemalloc and writes reports to profiles/.
+    profile = '--profile' in sys.argv
+    args = [a for a in sys.argv[1:] if a != '--profile']
     try:
-        if len(sys.argv) > 1:
-            server = sys.argv[1]
+        if profile:
+            run = lambda **kwparams: run_with_profile(main, schema, **kwparams)
+        else:
+            run = lambda **kwparams: main(schema, **kwparams)
+        if len(args) > 0 and args[0] == 'prepare':
+            # Pre-election warm-up: 'prepare' followed by the servers
+            # (by default, the test server) creates the resources ahead of time.
+            prepare(schema, servers=args[1:] or ['test'])
+        elif len(args) > 0:
             # When invoking this function from the command line, the
             # argument 'production' must be given to push data to
             # a public repository. Otherwise, it will default to going
-            # to a test directory.
-            main(schema, server=server)
-            # Note that the hash database is currently unaware of which
-            # server a file is saved to, so if it's first saved to
-            # the test server and you run the ETL script again for the
-            # production server, if the file hasn't changed, the script
-            # will not push the data to the production server.
+            # to a test directory. Several servers can be given
+            # (e.g., 'test production'), or 'all' for every server in
+            # the 'loader' section of the settings file; the files are
+            # then downloaded once and published to each of them.
+            # Each server has its own hash database, so a file that
+            # has already been pushed to the test server will still
+            # be pushed to the production server.
+            run(servers=args)
         else:
-            main(schema)
+            run()
     except:
         e = sys.exc_info()[0]
         print("Error: {} : ".format(e))
@@ -0,0 +1,216 @@
+import os, json, pickle
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+
+from detail_xml import iter_precinct_votes, read_precinct_turnout
+from publishing import upsert_records, delete_records, upload_file, slugify, ensure_directory
+
+# Precinct-level deltas between successive detailxml.zip snapshots.
+#
+# On election night, precincts report in waves, so from one cycle to the
+# next only a few hundred of the ~1300 precincts change. Rather than
+# reloading everything, the current detail.xml is diffed against the
+# previous one at the (contest, choice, vote type, precinct) level, and
+# only the rows that changed are upserted into the precinct datastore
+# table (and rows that have disappeared, say when a write-in choice is
+# dropped, are deleted from it). Precincts that report for the first
+# time also go into a separate "newly reporting precincts" feed.
+#
+# A snapshot can run to hundreds of thousands of rows, so rather than
+# nested dicts it's stored as a table of distinct strings plus two flat
+# arrays: one of string codes (four per row) and one of vote counts.
+
+key_width = 4 # contest, choice, vote type, precinct
+
+precinct_fields = [
+    {'id': 'contest_name', 'type': 'text'},
+    {'id': 'choice_name', 'type': 'text'},
+    {'id': 'party_name', 'type': 'text'},
+    {'id': 'vote_type', 'type': 'text'},
+    {'id': 'precinct_name', 'type': 'text'},
+    {'id': 'votes', 'type': 'int'},
+    {'id': 'previous_votes', 'type': 'int'},
+    {'id': 'updated_at', 'type': 'timestamp'},
+]
+precinct_key = ['contest_name', 'choice_name', 'vote_type', 'precinct_name']
+
+newly_reporting_fields = [
+    {'id': 'precinct_name', 'type': 'text'},
+    {'id': 'first_reported_at', 'type': 'timestamp'},
+    {'id': 'ballots_cast', 'type': 'int'},
+    {'id': 'registered_voters', 'type': 'int'},
+]
+
+class PrecinctSnapshot(object):
+    def __init__(self):
+        self.strings = []
+        self.string_codes = {}
+        self.codes = array('l')
+        self.votes = array('q')
+        self.parties = {} # (contest code, choice code) => party code
+        self.reporting = set() # codes of precincts with any votes
+
+    def intern(self, value):
+        if value is None:
+            value = ''
+        code = self.string_codes.get(value)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(value)
+            self.string_codes[value] = code
+        return code
+
+    def append(self, contest_name, choice_name, party_name, vote_type, precinct_name, votes):
+        key = (self.intern(contest_name), self.intern(choice_name), self.intern(vote_type), self.intern(precinct_name))
+        self.codes.extend(key)
+        self.votes.append(votes)
+        self.parties[key[:2]] = self.intern(party_name)
+        if votes > 0:
+            self.reporting.add(key[3])
+
+    def __len__(self):
+        return len(self.votes)
+
+    def key(self, k):
+        return tuple(self.codes[key_width * k:key_width * (k + 1)])
+
+    def index(self):
+        # Maps the row keys (as tuples of string codes) to row numbers.
+        return {self.key(k): k for k in range(len(self))}
+
+    def record(self, k, previous_votes=None):
+        contest, choice, vote_type, precinct = self.key(k)
+        return OrderedDict([
+            ('contest_name', self.strings[contest]),
+            ('choice_name', self.strings[choice]),
+            ('party_name', self.strings[self.parties[(contest, choice)]] or None),
+            ('vote_type', self.strings[vote_type]),
+            ('precinct_name', self.strings[precinct]),
+            ('votes', self.votes[k]),
+            ('previous_votes', previous_votes),
+            ])
+
+    def reporting_precincts(self):
+        return set(self.strings[c] for c in self.reporting)
+
+    def save(self, snapshot_file):
+        temp_file = snapshot_file + '.tmp'
+        with open(temp_file, 'wb') as f:
+            pickle.dump({'strings': self.strings, 'codes': self.codes.tobytes(), 'votes': self.votes.tobytes(),
+                'parties': self.parties, 'reporting': self.reporting}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, snapshot_file)
+
+    @classmethod
+    def load(cls, snapshot_file):
+        if not os.path.exists(snapshot_file):
+            return None
+        with open(snapshot_file, 'rb') as f:
+            stored = pickle.load(f)
+        snapshot = cls()
+        snapshot.strings = stored['strings']
+        snapshot.string_codes = {s: k for k, s in enumerate(snapshot.strings)}
+        snapshot.codes.frombytes(stored['codes'])
+        snapshot.votes.frombytes(stored['votes'])
+        snapshot.parties = stored['parties']
+        snapshot.reporting = stored['reporting']
+        return snapshot
+
+def read_snapshot(xml_zip):
+    snapshot = PrecinctSnapshot()
+    for row in iter_precinct_votes(xml_zip):
+        snapshot.append(*row)
+    return snapshot
+
+def diff_snapshots(previous, current):
+    # Returns the records of the rows of current that are new or whose
+    # vote counts differ from those in previous, and the records of the
+    # rows of previous that are missing from current.
+    if previous is None:
+        return [current.record(k) for k in range(len(current))], []
+    # The two snapshots code their strings independently, so translate
+    # current's codes into previous's (once per distinct string) and
+    # compare integer keys. A string that previous never saw can't be
+    # part of a key that previous has.
+    translation = [previous.string_codes.get(value) for value in current.strings]
+    previous_index = previous.index()
+    changed = []
+    for k in range(len(current)):
+        j = previous_index.pop(tuple(translation[c] for c in current.key(k)), None)
+        if j is None:
+            changed.append(current.record(k))
+        elif previous.votes[j] != current.votes[k]:
+            changed.append(current.record(k, previous.votes[j]))
+    removed = [previous.record(j) for j in sorted(previous_index.values())]
+    return changed, removed
+
+def newly_reporting_precincts(previous, current, xml_zip):
+    already_reporting = previous.reporting_precincts() if previous is not None else set()
+    new_precincts = current.reporting_precincts() - already_reporting
+    if len(new_precincts) == 0:
+        return []
+    now = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    turnout = {t['precinct_name']: t for t in read_precinct_turnout(xml_zip)}
+    feed = []
+    for precinct_name in sorted(new_precincts):
+        t = turnout.get(precinct_name, {})
+        feed.append(OrderedDict([
+            ('precinct_name', precinct_name),
+            ('first_reported_at', now),
+            ('ballots_cast', t.get('ballots_cast')),
+            ('registered_voters', t.get('registered_voters')),
+            ]))
+    return feed
+
+def precinct_resource_names(r_name):
+    # The precinct table, the newly reporting precincts table and the JSON feed.
+    return r_name + ' by Precinct', r_name + ' Newly Reporting Precincts', r_name + ' Precinct Changes (JSON)'
+
+def snapshot_path(snapshot_dir, server, r_name):
+    return "{}/precincts-{}-{}.snapshot".format(ensure_directory(snapshot_dir), server, slugify(r_name))
+
+def publish_precinct_deltas(site, package_id, API_key, server, r_name, xml_zip, snapshot_dir, output_dir, resource_ids=None):
+    # Diffs the detail XML against the last published snapshot, upserts
+    # the changed rows and the newly reporting precincts, deletes the
+    # removed rows, and writes all of these to a static JSON feed. Returns
+    # the number of changed and removed rows, and the new snapshot, which
+    # the caller saves (with save_snapshot()) once the zipped XML file has
+    # been uploaded too, so that a failed upload is retried next cycle.
+    # resource_ids maps resource names to the IDs cached by warmup.py.
+    resource_ids = resource_ids or {}
+    table_name, newly_reporting_name, feed_name = precinct_resource_names(r_name)
+    snapshot_file = snapshot_path(snapshot_dir, server, r_name)
+    previous = PrecinctSnapshot.load(snapshot_file)
+    current = read_snapshot(xml_zip)
+    changed, removed = diff_snapshots(previous, current)
+    newly_reporting = newly_reporting_precincts(previous, current, xml_zip)
+    print("{} of {} precinct rows changed and {} were removed; {} precincts reported for the first time.".format(
+        len(changed), len(current), len(removed), len(newly_reporting)))
+    if len(changed) == 0 and len(removed) == 0 and len(newly_reporting) == 0:
+        return 0, None
+
+    now = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    for record in changed:
+        record['updated_at'] = now
+    upsert_records(site, package_id, table_name, precinct_fields, changed,
+        primary_key=precinct_key, API_key=API_key, resource_id=resource_ids.get(table_name))
+    if len(removed) > 0:
+        delete_records(site, package_id, table_name, removed, precinct_key, API_key=API_key, resource_id=resource_ids.get(table_name))
+    if len(newly_reporting) > 0:
+        upsert_records(site, package_id, newly_reporting_name, newly_reporting_fields, newly_reporting,
+            primary_key=['precinct_name'], API_key=API_key, resource_id=resource_ids.get(newly_reporting_name))
+
+    ensure_directory(output_dir)
+    feed_file = "{}/{}-precinct-changes.json".format(output_dir, slugify(r_name))
+    temp_file = feed_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(OrderedDict([('election', r_name), ('generated_at', now),
+            ('changed_rows', changed), ('removed_rows', [OrderedDict((k, r[k]) for k in precinct_key) for r in removed]),
+            ('newly_reporting_precincts', newly_reporting)]), f)
+    os.replace(temp_file, feed_file)
+    upload_file(site, package_id, feed_name, feed_file, API_key=API_key, resource_id=resource_ids.get(feed_name))
+
+    return len(changed) + len(removed), current
+
+def save_snapshot(snapshot, snapshot_dir, server, r_name):
+    snapshot.save(snapshot_path(snapshot_dir, server, r_name))
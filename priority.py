@@ -0,0 +1,83 @@
+import os, re, csv, json, time
+
+from aggregates import normalize_header, group_by_contest
+
+# Priority-ordered publishing.
+#
+# A full upsert of summary.csv goes in line_number order, so the top of
+# the ticket can wait behind hundreds of borough council and judicial
+# retention rows. Instead, the rows of the priority contests are written
+# to their own CSV file and upserted first, and the rest follow in a
+# second batch. The priority contests are configured under 'priority' in
+# the settings file:
+#   "priority": {"contest_patterns": ["^President", "^Governor", "Mayor"],
+#                "largest_changes": 5}
+# contest_patterns are regular expressions (matched case-insensitively
+# against the contest name) and largest_changes adds the contests whose
+# total votes grew the most since the last published cycle.
+
+default_priority_settings = {
+    'contest_patterns': [],
+    'largest_changes': 0,
+    }
+
+def previous_contest_totals(db, r_name):
+    # The total votes of each contest as of the last published cycle
+    # (from the aggregates that aggregates.py saves).
+    totals = {}
+    for entry in db['contest_aggregates'].find(inferred_results=r_name):
+        totals[entry['contest_name']] = json.loads(entry['aggregate'])['total_votes'] or 0
+    return totals
+
+def priority_contests(db, r_name, rows, settings=None):
+    config = dict(default_priority_settings)
+    config.update(settings or {})
+    totals = {contest_name: sum(r['total_votes'] or 0 for r in contest_rows) for contest_name, contest_rows in group_by_contest(rows).items()}
+    chosen = set()
+    for pattern in config['contest_patterns']:
+        chosen.update(c for c in totals if re.search(pattern, c, re.IGNORECASE))
+    if config['largest_changes'] > 0:
+        previous = previous_contest_totals(db, r_name)
+        changes = sorted(((totals[c] - previous.get(c, 0), c) for c in totals if c not in chosen), reverse=True)
+        chosen.update(c for change, c in changes[:config['largest_changes']] if change > 0)
+    return chosen
+
+def split_summary_csv(target, encoding, contests, suffix):
+    # Returns the CSV files to upsert, in order. If there's nothing to
+    # split, that's just the original file.
+    if len(contests) == 0:
+        return [target]
+    base, extension = os.path.splitext(target)
+    priority_file = "{}-{}-priority{}".format(base, suffix, extension)
+    rest_file = "{}-{}-rest{}".format(base, suffix, extension)
+    counts = [0, 0]
+    with open(target, 'r', encoding=encoding, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        contest_column = [normalize_header(h) for h in header].index('contest_name')
+        with open(priority_file, 'w', encoding=encoding, newline='') as p, open(rest_file, 'w', encoding=encoding, newline='') as r:
+            writers = [csv.writer(p), csv.writer(r)]
+            for writer in writers:
+                writer.writerow(header)
+            for row in reader:
+                k = 0 if row[contest_column] in contests else 1
+                writers[k].writerow(row)
+                counts[k] += 1
+    if counts[0] == 0 or counts[1] == 0:
+        os.remove(priority_file)
+        os.remove(rest_file)
+        return [target]
+    print("Upserting {} rows from {} priority contests before the other {} rows.".format(counts[0], len(contests), counts[1]))
+    return [priority_file, rest_file]
+
+def record_priority_batch(db, r_name, contests, started_at, last_modified):
+    # Reports the time to the first priority row: the time from the start
+    # of publishing (and from the county's publishing of the file) until
+    # the priority batch has been committed.
+    finished_at = time.time()
+    since_start = finished_at - started_at
+    since_county = finished_at - time.mktime(last_modified.timetuple()) if last_modified is not None else None
+    db['priority_latencies'].insert(dict(election=r_name, contests=len(contests), finished_at=finished_at,
+        since_start=since_start, since_county_published=since_county))
+    print("The priority rows of {} landed {:.1f} seconds into publishing{}.".format(r_name, since_start,
+        " ({:.0f} seconds after the county published them)".format(since_county) if since_county is not None else ""))
@@ -0,0 +1,171 @@
+import os, sys, json, time, threading, cProfile, pstats, tracemalloc
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+# Profiling of a single ETL cycle (the --profile command-line option).
+#
+# run_with_profile() wraps a function (main()) with cProfile, tracemalloc
+# and a sampling thread that records the main thread's stack, and writes
+# these to a timestamped directory under profiles/:
+#   cprofile.prof    pstats dump (for snakeviz, pstats, etc.)
+#   cprofile.txt     the top functions by cumulative time
+#   stages.json      wall time, CPU time and allocations for each stage
+#   stages.txt       the same, plus the top allocation sites of each stage
+#   stacks.folded    sampled stacks in the folded format that
+#                    flamegraph.pl and speedscope read
+#
+# Stages are marked in the ETL code with
+#   with stage('discovery'):
+#       ...
+# When no profile is running, stage() does nothing but check a global,
+# so it costs next to nothing. cProfile, the sampler and the stage timings
+# (process_time() is process-wide) only make sense for one thread, so
+# stage() also does nothing outside the profiled thread, and the ETL
+# publishes to its targets one at a time while profiling (is_profiling()).
+
+active_profile = None
+
+class Profile(object):
+    def __init__(self, output_dir, sample_interval):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.stages = []
+        self.open_stages = [OpenStage(0)] # The whole run, then the stages being timed
+        self.stacks = Counter()
+        self.stopping = threading.Event()
+        self.thread_id = threading.get_ident()
+        self.profiler = cProfile.Profile()
+
+    def sample(self):
+        # Runs in its own thread, recording the stack of the profiled thread.
+        while not self.stopping.wait(self.sample_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+def is_profiling():
+    return active_profile is not None
+
+class OpenStage(object):
+    # The running totals of a stage that hasn't finished yet.
+    def __init__(self, peak):
+        self.peak = peak # The highest traced memory seen so far (absolute)
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+
+    def add_child(self, wall, cpu, peak):
+        self.child_wall += wall
+        self.child_cpu += cpu
+        self.peak = max(self.peak, peak)
+
+@contextmanager
+def stage(name):
+    # Stages can be nested (for instance, 'pipeline upsert' inside
+    # 'publishing'). tracemalloc has a single peak counter, so before an
+    # inner stage resets it, the peak so far is saved on the enclosing
+    # stage, and when the inner stage ends, its peak is passed back up.
+    profile = active_profile
+    if profile is None or threading.get_ident() != profile.thread_id:
+        yield
+        return
+    # Keep the snapshot bookkeeping out of the cProfile results.
+    profile.profiler.disable()
+    before = tracemalloc.take_snapshot()
+    current_before, peak_so_far = tracemalloc.get_traced_memory()
+    parent = profile.open_stages[-1]
+    parent.peak = max(parent.peak, peak_so_far)
+    tracemalloc.reset_peak()
+    this = OpenStage(current_before)
+    profile.open_stages.append(this)
+    # Added now, so that the stages are listed in the order they started.
+    record = OrderedDict([('stage', name), ('depth', len(profile.open_stages) - 2)])
+    profile.stages.append(record)
+    profile.profiler.enable()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        profile.profiler.disable()
+        current_after, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, this.peak)
+        profile.open_stages.pop()
+        parent.add_child(wall, cpu, peak)
+        after = tracemalloc.take_snapshot()
+        top = after.compare_to(before, 'lineno')[:10]
+        profile.profiler.enable()
+        record.update([
+            ('wall_seconds', round(wall, 4)),
+            ('self_wall_seconds', round(wall - this.child_wall, 4)),
+            ('cpu_seconds', round(cpu, 4)),
+            ('self_cpu_seconds', round(cpu - this.child_cpu, 4)),
+            ('net_allocated_bytes', current_after - current_before),
+            ('peak_bytes_above_start', peak - current_before),
+            ('top_allocations', [str(s) for s in top]),
+            ])
+
+def write_reports(profile):
+    profiler = profile.profiler
+    profiler.dump_stats(os.path.join(profile.output_dir, 'cprofile.prof'))
+    with open(os.path.join(profile.output_dir, 'cprofile.txt'), 'w') as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats('cumulative').print_stats(60)
+
+    with open(os.path.join(profile.output_dir, 'stages.json'), 'w') as f:
+        json.dump([OrderedDict((k, v) for k, v in s.items() if k != 'top_allocations') for s in profile.stages], f, indent=2)
+    with open(os.path.join(profile.output_dir, 'stages.txt'), 'w') as f:
+        # Nested stages are indented under the stage that contains them,
+        # whose wall and CPU times include theirs; the self columns don't.
+        f.write("{:<28} {:>10} {:>10} {:>10} {:>10} {:>14} {:>14}\n".format('stage', 'wall (s)', 'self (s)', 'CPU (s)', 'self (s)', 'net alloc (B)', 'peak (B)'))
+        for s in profile.stages:
+            f.write("{:<28} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>14} {:>14}\n".format('  ' * s['depth'] + s['stage'],
+                s['wall_seconds'], s['self_wall_seconds'], s['cpu_seconds'], s['self_cpu_seconds'],
+                s['net_allocated_bytes'], s['peak_bytes_above_start']))
+        for s in profile.stages:
+            f.write("\nTop allocation sites in stage '{}':\n".format(s['stage']))
+            for line in s['top_allocations']:
+                f.write("    {}\n".format(line))
+
+    with open(os.path.join(profile.output_dir, 'stacks.folded'), 'w') as f:
+        for stack, count in profile.stacks.most_common():
+            f.write("{} {}\n".format(stack, count))
+
+def run_with_profile(function, *args, **kwargs):
+    global active_profile
+    profile_root = kwargs.pop('profile_root', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+    sample_interval = kwargs.pop('sample_interval', 0.005)
+    output_dir = os.path.join(profile_root, datetime.now().strftime("%Y%m%d-%H%M%S"))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    profile = Profile(output_dir, sample_interval)
+    sampler = threading.Thread(target=profile.sample, daemon=True)
+    tracemalloc.start(10)
+    active_profile = profile
+    sampler.start()
+    profile.profiler.enable()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        profile.profiler.disable()
+        current, peak = tracemalloc.get_traced_memory()
+        run = profile.open_stages[0]
+        profile.stages.append(OrderedDict([('stage', 'total'), ('depth', 0),
+            ('wall_seconds', round(wall, 4)), ('self_wall_seconds', round(wall - run.child_wall, 4)),
+            ('cpu_seconds', round(cpu, 4)), ('self_cpu_seconds', round(cpu - run.child_cpu, 4)),
+            ('net_allocated_bytes', current), ('peak_bytes_above_start', max(peak, run.peak)),
+            ('top_allocations', [])]))
+        profile.stopping.set()
+        sampler.join()
+        active_profile = None
+        tracemalloc.stop()
+        write_reports(profile)
+        print("Profiling reports written to {}".format(output_dir))
@@ -0,0 +1,91 @@
+import os, re
+from ckanapi import RemoteCKAN
+
+# Small helpers for pushing derived resources (aggregates, exports, feeds)
+# to the same CKAN package as the election results.
+
+def find_resource_id(site, package_id, resource_name, API_key=None):
+    ckan = RemoteCKAN(site, apikey=API_key)
+    metadata = ckan.action.package_show(id=package_id)
+    for r in metadata['resources']:
+        if r['name'] == resource_name:
+            return r['id']
+    return None
+
+def upload_file(site, package_id, resource_name, file_path, API_key=None, resource_id=None):
+    # Create or replace a file-upload resource, returning its resource ID.
+    ckan = RemoteCKAN(site, apikey=API_key)
+    if resource_id is None:
+        resource_id = find_resource_id(site, package_id, resource_name, API_key=API_key)
+    with open(file_path, 'rb') as upload:
+        if resource_id is None:
+            resource = ckan.action.resource_create(
+                package_id=package_id,
+                url='dummy-value',  # ignored but required by CKAN<2.6
+                name=resource_name,
+                upload=upload)
+        else:
+            resource = ckan.action.resource_update(
+                package_id=package_id,
+                url='dummy-value',  # ignored but required by CKAN<2.6
+                id=resource_id,
+                upload=upload)
+    return resource['id']
+
+def create_resource(site, package_id, resource_name, API_key=None):
+    # Create a resource with no file yet, returning its resource ID.
+    ckan = RemoteCKAN(site, apikey=API_key)
+    resource = ckan.action.resource_create(
+        package_id=package_id,
+        url='dummy-value',  # ignored but required by CKAN<2.6
+        name=resource_name)
+    return resource['id']
+
+def create_datastore(site, package_id, resource_name, fields, primary_key, API_key=None):
+    # Create a resource with an empty datastore table, returning its resource ID.
+    ckan = RemoteCKAN(site, apikey=API_key)
+    result = ckan.action.datastore_create(
+        resource={'package_id': package_id, 'name': resource_name},
+        fields=fields,
+        primary_key=primary_key,
+        force=True)
+    return result['resource_id']
+
+def upsert_records(site, package_id, resource_name, fields, records, primary_key, API_key=None, resource_id=None, chunk_size=5000):
+    # Upsert records into a datastore table, creating the resource (and the
+    # table) the first time through. Returns the resource ID.
+    ckan = RemoteCKAN(site, apikey=API_key)
+    if resource_id is None:
+        resource_id = find_resource_id(site, package_id, resource_name, API_key=API_key)
+    if resource_id is None:
+        resource_id = create_datastore(site, package_id, resource_name, fields, primary_key, API_key=API_key)
+    for k in range(0, len(records), chunk_size):
+        ckan.action.datastore_upsert(
+            resource_id=resource_id,
+            records=records[k:k + chunk_size],
+            method='upsert',
+            force=True)
+    return resource_id
+
+def delete_records(site, package_id, resource_name, records, primary_key, API_key=None, resource_id=None):
+    # Delete the rows with the primary keys of the given records from a
+    # datastore table (one datastore_delete call per row).
+    ckan = RemoteCKAN(site, apikey=API_key)
+    if resource_id is None:
+        resource_id = find_resource_id(site, package_id, resource_name, API_key=API_key)
+    if resource_id is None:
+        return None
+    for record in records:
+        ckan.action.datastore_delete(
+            resource_id=resource_id,
+            filters={k: record[k] for k in primary_key},
+            force=True)
+    return resource_id
+
+def slugify(name):
+    return re.sub('[^a-z0-9]+', '-', name.lower()).strip('-')
+
+def ensure_directory(path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
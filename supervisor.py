@@ -0,0 +1,188 @@
+import os, sys, time, signal, importlib, traceback, argparse
+import multiprocessing
+from collections import OrderedDict
+from datetime import datetime
+import dataset
+
+from notify import send_to_slack
+from discovery import percentile
+from jurisdictions import load_jurisdictions, jurisdiction_state_dir
+from locking import read_json, write_json
+from publishing import ensure_directory
+
+# Mirroring several counties at once.
+#
+# The supervisor reads a jurisdiction config file (see jurisdictions.py)
+# and runs one ETL cycle per jurisdiction in a pool of worker processes.
+# A slow or crashing county then can't hold up the others. Each
+# jurisdiction (shard) keeps its state in its own directory under shards/:
+# hash databases, locks, discovery history, snapshots and temporary files.
+# A shard isn't polled again until min_interval seconds after its last
+# cycle started.
+#
+# After each round, the supervisor reports throughput (cycles and
+# publishes per minute) and latency (this round's cycle times, plus
+# rolling p50/p95 per shard). The report is printed and also written to
+# shards/supervisor-report.json. The cycle history is kept in supervisor.db.
+#
+# Every cycle runs in a fresh worker process (maxtasksperchild=1), and the
+# worker quits its pooled browsers when the cycle ends, since nothing else
+# would (see run_shard). The tradeoff is that the browser pool of
+# election_results_etl.py doesn't carry over from one cycle to the next, so
+# under the supervisor every Selenium discovery pays Chrome's full startup
+# time. Clarity discovery doesn't use a browser, so this only matters for
+# shards that fall back to Selenium; for a county that always needs it,
+# running election_results_etl.py --watch on its own keeps the pool warm.
+#
+# Usage:
+#   python supervisor.py jurisdictions.json [server ...] [--processes 4] [--watch 120]
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+
+def run_shard(script, jurisdiction, servers):
+    # Runs one cycle for one jurisdiction. This is called in a worker process.
+    state_dir = jurisdiction_state_dir(root_dir, jurisdiction)
+    schedule_file = state_dir + '/schedule.json'
+    last_cycle = read_json(schedule_file)
+    if last_cycle is not None and time.time() - last_cycle['started_at'] < jurisdiction['min_interval']:
+        return dict(name=jurisdiction['name'], status='rate limited', outcomes=None, seconds=0.0, error=None)
+    started_at = time.time()
+    write_json(schedule_file, dict(started_at=started_at))
+
+    outcomes, error = None, None
+    try:
+        module = importlib.import_module(script)
+        outcomes = module.main(module.schema, jurisdiction=jurisdiction, servers=servers)
+        status = 'locked' if outcomes is None else 'ok'
+    except Exception:
+        status = 'failed'
+        error = traceback.format_exc()
+    finally:
+        # Quit any browsers the cycle started (see close_worker_on_sigterm).
+        close_browser_pool = getattr(sys.modules.get(script), 'close_browser_pool', None)
+        if close_browser_pool is not None:
+            close_browser_pool()
+    return dict(name=jurisdiction['name'], status=status, outcomes=outcomes, seconds=time.time() - started_at, error=error)
+
+def close_worker_on_sigterm():
+    # Pool.terminate() sends SIGTERM to the workers, which by default kills
+    # them without running any cleanup, leaving their Chrome processes
+    # behind. Raising SystemExit instead lets run_shard's finally block
+    # quit the browsers.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+def start_pool(processes, shard_count):
+    # A new process for every cycle keeps one county's memory use (or
+    # module-level state) from carrying over to the next.
+    return multiprocessing.Pool(processes=min(processes, shard_count), maxtasksperchild=1,
+        initializer=close_worker_on_sigterm)
+
+def run_round(pool, script, jurisdictions, servers, timeout):
+    # Returns the results of the round and whether any cycle timed out
+    # (in which case the pool's workers may still be busy with it).
+    pending = OrderedDict()
+    for jurisdiction in jurisdictions:
+        pending[jurisdiction['name']] = pool.apply_async(run_shard, (script, jurisdiction, servers))
+    deadline = time.time() + timeout
+    results, timed_out = [], False
+    for name, async_result in pending.items():
+        try:
+            results.append(async_result.get(timeout=max(0, deadline - time.time())))
+        except multiprocessing.TimeoutError:
+            timed_out = True
+            results.append(dict(name=name, status='timed out', outcomes=None, seconds=timeout, error=None))
+    return results, timed_out
+
+def rounded(seconds):
+    return round(seconds, 2) if seconds is not None else None
+
+def count_published(result):
+    return len([o for o in (result['outcomes'] or {}).values() if o == 'published'])
+
+def record_round(db, results, finished_at):
+    for result in results:
+        if result['status'] in ['rate limited', 'locked']:
+            continue
+        db['shard_cycles'].insert(dict(shard=result['name'], status=result['status'], seconds=result['seconds'],
+            published=count_published(result), finished_at=finished_at))
+
+def build_report(db, results, round_seconds, window):
+    cycles = [r for r in results if r['status'] not in ['rate limited', 'locked']]
+    latencies = [r['seconds'] for r in cycles]
+    shards = OrderedDict()
+    for result in results:
+        recent = db['shard_cycles'].find(shard=result['name'], order_by='-finished_at', _limit=window)
+        history = [entry['seconds'] for entry in recent if entry['status'] == 'ok']
+        shards[result['name']] = OrderedDict([
+            ('status', result['status']),
+            ('seconds', round(result['seconds'], 2)),
+            ('published', count_published(result)),
+            ('p50_seconds', rounded(percentile(history, 50))),
+            ('p95_seconds', rounded(percentile(history, 95))),
+            ])
+    minutes = max(round_seconds, 0.001) / 60.0
+    return OrderedDict([
+        ('finished', datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+        ('round_seconds', round(round_seconds, 2)),
+        ('cycles', len(cycles)),
+        ('failures', len([r for r in cycles if r['status'] != 'ok'])),
+        ('cycles_per_minute', round(len(cycles) / minutes, 2)),
+        ('publishes_per_minute', round(sum(count_published(r) for r in cycles) / minutes, 2)),
+        ('p50_seconds', rounded(percentile(latencies, 50))),
+        ('p95_seconds', rounded(percentile(latencies, 95))),
+        ('shards', shards),
+        ])
+
+def print_report(report):
+    print("Round finished in {} seconds: {} cycles ({} failed), {} cycles/minute, {} publishes/minute, p50 = {}, p95 = {}".format(
+        report['round_seconds'], report['cycles'], report['failures'], report['cycles_per_minute'],
+        report['publishes_per_minute'], report['p50_seconds'], report['p95_seconds']))
+    for name, shard in report['shards'].items():
+        print("    {:<24} {:<12} {:>8} s  published to {}  (rolling p50 = {}, p95 = {})".format(name, shard['status'],
+            shard['seconds'], shard['published'], shard['p50_seconds'], shard['p95_seconds']))
+
+def supervise(config_file, servers, processes, timeout, watch=None, script='election_results_etl', window=50):
+    jurisdictions = load_jurisdictions(config_file)
+    db = dataset.connect('sqlite:///{}/supervisor.db'.format(root_dir))
+    report_file = ensure_directory(root_dir + '/shards') + '/supervisor-report.json'
+    pool = start_pool(processes, len(jurisdictions))
+    try:
+        while True:
+            round_start = time.time()
+            results, timed_out = run_round(pool, script, jurisdictions, servers, timeout)
+            round_seconds = time.time() - round_start
+            record_round(db, results, time.time())
+            report = build_report(db, results, round_seconds, window)
+            print_report(report)
+            write_json(report_file, report)
+
+            for result in results:
+                if result['status'] in ['failed', 'timed out']:
+                    msg = "countermeasures could not complete a cycle for {} ({}).".format(result['name'], result['status'])
+                    if result['error'] is not None:
+                        msg += "\nHere's the traceback:\n{}".format(result['error'])
+                    print(msg)
+                    send_to_slack(msg, username='countermeasures', channel='@david', icon=':satellite_antenna:')
+
+            if timed_out:
+                # The workers running hung cycles can't be reclaimed, so
+                # start over with a fresh pool.
+                pool.terminate()
+                pool = start_pool(processes, len(jurisdictions))
+            if watch is None:
+                return report
+            time.sleep(max(0, watch - round_seconds))
+    finally:
+        pool.terminate()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run ETL cycles for several jurisdictions in a pool of worker processes.')
+    parser.add_argument('config_file', help='JSON file listing the jurisdictions')
+    parser.add_argument('servers', nargs='*', default=['test'], help="servers to publish to (or 'all')")
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for a round of cycles')
+    parser.add_argument('--watch', type=float, default=None, help='keep running, starting a round every WATCH seconds')
+    parser.add_argument('--phantom', action='store_true', help='use phantom_countermeasures.py instead of election_results_etl.py')
+    args = parser.parse_args()
+    script = 'phantom_countermeasures' if args.phantom else 'election_results_etl'
+    supervise(args.config_file, args.servers, args.processes, args.timeout, args.watch, script)
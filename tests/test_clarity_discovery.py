@@ -0,0 +1,84 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from discovery import parse_election_url, discover_report_urls, DiscoveryError
+
+LANDING_URL = 'http://results.enr.clarityelections.com/PA/Allegheny/71801/Web02/#/'
+
+class ClarityStub(object):
+    # A stand-in for the Clarity site, serving the files in self.files.
+    def __init__(self):
+        self.files = {}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def respond(self, include_body):
+                body = stub.files.get(self.path)
+                if body is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if include_body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond(True)
+
+            def do_HEAD(self):
+                self.respond(False)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('localhost', 0), Handler)
+        self.root_url = 'http://localhost:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+@pytest.fixture
+def clarity():
+    stub = ClarityStub()
+    stub.files['/PA/Allegheny/71801/current_ver.txt'] = b'189912\n'
+    stub.files['/PA/Allegheny/71801/189912/reports/summary.zip'] = b'PK'
+    stub.files['/PA/Allegheny/71801/189912/reports/detailxml.zip'] = b'PK'
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+def test_parse_election_url():
+    assert parse_election_url(LANDING_URL) == ('https://results.enr.clarityelections.com/PA/Allegheny/71801', '71801')
+    assert parse_election_url(LANDING_URL, 'http://localhost:8000/clarity/') == ('http://localhost:8000/clarity/PA/Allegheny/71801', '71801')
+    with pytest.raises(DiscoveryError):
+        parse_election_url('http://results.enr.clarityelections.com/PA/Allegheny/Web02/#/')
+
+def test_discovers_the_current_report_urls(clarity):
+    summary_file_url, xml_file_url = discover_report_urls(LANDING_URL, timeout=5, root_url=clarity.root_url)
+    assert summary_file_url == clarity.root_url + '/PA/Allegheny/71801/189912/reports/summary.zip'
+    assert xml_file_url == clarity.root_url + '/PA/Allegheny/71801/189912/reports/detailxml.zip'
+
+def test_a_non_numeric_version_is_rejected(clarity):
+    clarity.files['/PA/Allegheny/71801/current_ver.txt'] = b'<html>Maintenance</html>'
+    with pytest.raises(DiscoveryError, match='Unexpected contents'):
+        discover_report_urls(LANDING_URL, timeout=5, root_url=clarity.root_url)
+
+def test_a_missing_version_file_is_an_error(clarity):
+    del clarity.files['/PA/Allegheny/71801/current_ver.txt']
+    with pytest.raises(DiscoveryError, match='status code 404'):
+        discover_report_urls(LANDING_URL, timeout=5, root_url=clarity.root_url)
+
+def test_a_report_that_fails_its_head_check_is_an_error(clarity):
+    del clarity.files['/PA/Allegheny/71801/189912/reports/detailxml.zip']
+    with pytest.raises(DiscoveryError, match='detailxml.zip returned status code 404'):
+        discover_report_urls(LANDING_URL, timeout=5, root_url=clarity.root_url)
+    # Without the HEAD checks, the guessed URLs are returned as they are.
+    summary_file_url, xml_file_url = discover_report_urls(LANDING_URL, timeout=5, root_url=clarity.root_url, verify=False)
+    assert xml_file_url.endswith('/189912/reports/detailxml.zip')
+
+def test_an_unreachable_site_is_an_error():
+    with pytest.raises(DiscoveryError, match='Unable to reach'):
+        discover_report_urls(LANDING_URL, timeout=2, root_url='http://localhost:9')
@@ -0,0 +1,111 @@
+import os, sys, time, subprocess
+
+import dataset
+import pytest
+
+from discovery import discover_with_fallbacks, record_success, DiscoveryError
+
+URLS = ('https://example.com/summary.zip', 'https://example.com/detailxml.zip')
+
+@pytest.fixture
+def db(tmp_path):
+    return dataset.connect('sqlite:///{}/discovery.db'.format(tmp_path))
+
+def answering(calls, name, delay=0.0):
+    def function(url):
+        calls.append(name)
+        time.sleep(delay)
+        return URLS
+    return function
+
+def failing(calls, name):
+    def function(url):
+        calls.append(name)
+        raise RuntimeError("{} is down".format(name))
+    return function
+
+def test_falls_back_after_a_failure(db):
+    calls = []
+    backends = [{'name': 'clarity', 'function': failing(calls, 'clarity'), 'timeout': 5},
+        {'name': 'selenium', 'function': answering(calls, 'selenium'), 'timeout': 5}]
+    assert discover_with_fallbacks('url', backends, db) == URLS + ('selenium',)
+    assert calls == ['clarity', 'selenium']
+    assert db['circuit_breakers'].find_one(backend='clarity')['consecutive_failures'] == 1
+
+def test_a_backend_that_times_out_is_abandoned(db):
+    calls = []
+    backends = [{'name': 'clarity', 'function': answering(calls, 'clarity', delay=2.0), 'timeout': 0.2},
+        {'name': 'selenium', 'function': answering(calls, 'selenium'), 'timeout': 5}]
+    start = time.time()
+    assert discover_with_fallbacks('url', backends, db) == URLS + ('selenium',)
+    assert time.time() - start < 1.5
+    assert db['circuit_breakers'].find_one(backend='clarity')['consecutive_failures'] == 1
+
+def test_raises_when_every_backend_fails(db):
+    calls = []
+    backends = [{'name': 'clarity', 'function': failing(calls, 'clarity'), 'timeout': 5},
+        {'name': 'selenium', 'function': failing(calls, 'selenium'), 'timeout': 5}]
+    with pytest.raises(DiscoveryError):
+        discover_with_fallbacks('url', backends, db)
+
+def test_an_open_breaker_skips_the_backend_until_the_cooldown(db):
+    calls = []
+    backends = [{'name': 'clarity', 'function': failing(calls, 'clarity'), 'timeout': 5},
+        {'name': 'selenium', 'function': answering(calls, 'selenium'), 'timeout': 5}]
+    settings = {'failure_threshold': 2, 'cooldown': 600}
+    for _ in range(2):
+        discover_with_fallbacks('url', backends, db, settings)
+    assert calls.count('clarity') == 2
+    discover_with_fallbacks('url', backends, db, settings)
+    assert calls.count('clarity') == 2 # The breaker is open.
+
+    # After the cooldown, the breaker is half-open and lets one call through.
+    db['circuit_breakers'].update(dict(backend='clarity', opened_at=time.time() - 601), ['backend'])
+    discover_with_fallbacks('url', backends, db, settings)
+    assert calls.count('clarity') == 3
+
+def test_every_breaker_open_raises(db):
+    calls = []
+    backends = [{'name': 'clarity', 'function': failing(calls, 'clarity'), 'timeout': 5}]
+    settings = {'failure_threshold': 1, 'cooldown': 600}
+    with pytest.raises(DiscoveryError):
+        discover_with_fallbacks('url', backends, db, settings)
+    with pytest.raises(DiscoveryError):
+        discover_with_fallbacks('url', backends, db, settings)
+    assert calls == ['clarity']
+
+def test_a_slow_call_is_hedged_after_its_p90_latency(db):
+    for _ in range(5):
+        record_success(db, 'clarity', 0.05)
+    calls = []
+    backends = [{'name': 'clarity', 'function': answering(calls, 'clarity', delay=2.0), 'timeout': 5},
+        {'name': 'selenium', 'function': answering(calls, 'selenium'), 'timeout': 5}]
+    start = time.time()
+    assert discover_with_fallbacks('url', backends, db, {'hedge': True}) == URLS + ('selenium',)
+    assert time.time() - start < 1.0
+    assert calls == ['clarity', 'selenium']
+
+def test_no_hedging_without_enough_latency_history(db):
+    for _ in range(2):
+        record_success(db, 'clarity', 0.05)
+    calls = []
+    backends = [{'name': 'clarity', 'function': answering(calls, 'clarity', delay=0.3), 'timeout': 5},
+        {'name': 'selenium', 'function': answering(calls, 'selenium'), 'timeout': 5}]
+    assert discover_with_fallbacks('url', backends, db, {'hedge': True}) == URLS + ('clarity',)
+    assert calls == ['clarity']
+
+def test_an_abandoned_call_does_not_keep_the_process_alive(tmp_path):
+    script = tmp_path / 'chain.py'
+    script.write_text("""import sys, time
+sys.path.insert(0, {root!r})
+import dataset
+from discovery import discover_with_fallbacks
+db = dataset.connect('sqlite:///:memory:')
+backends = [{{'name': 'clarity', 'function': lambda url: time.sleep(30), 'timeout': 0.2}},
+    {{'name': 'selenium', 'function': lambda url: ('summary', 'xml'), 'timeout': 5}}]
+print(discover_with_fallbacks('url', backends, db))
+""".format(root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    start = time.time()
+    output = subprocess.run([sys.executable, str(script)], stdout=subprocess.PIPE, timeout=25, check=True).stdout
+    assert b"'selenium'" in output
+    assert time.time() - start < 10
@@ -0,0 +1,90 @@
+import socket, threading
+
+import pytest
+import requests
+import ckanapi
+
+from local_ckan import serve
+
+@pytest.fixture
+def ckan(tmp_path):
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+    server = serve(port, str(tmp_path / 'ckan'))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield ckanapi.RemoteCKAN('http://localhost:{}'.format(port), apikey='local')
+    server.shutdown()
+    server.server_close()
+
+fields = [{'id': 'contest_name', 'type': 'text'}, {'id': 'choice_name', 'type': 'text'}, {'id': 'votes', 'type': 'int'}]
+
+def create_table(ckan, primary_key=['contest_name', 'choice_name']):
+    resource = ckan.action.resource_create(package_id='election-results', name='Results', url='dummy-value')
+    ckan.action.datastore_create(resource_id=resource['id'], fields=fields, primary_key=primary_key)
+    return resource['id']
+
+def test_upsert_replaces_rows_with_the_same_key(ckan):
+    resource_id = create_table(ckan)
+    ckan.action.datastore_upsert(resource_id=resource_id, method='upsert', force=True,
+        records=[{'contest_name': 'Mayor', 'choice_name': 'A', 'votes': 1}, {'contest_name': 'Mayor', 'choice_name': 'B', 'votes': 2}])
+    ckan.action.datastore_upsert(resource_id=resource_id, method='upsert', force=True,
+        records=[{'contest_name': 'Mayor', 'choice_name': 'A', 'votes': 10}])
+    result = ckan.action.datastore_search(resource_id=resource_id, sort='choice_name asc')
+    assert result['total'] == 2
+    assert [(r['choice_name'], r['votes']) for r in result['records']] == [('A', 10), ('B', 2)]
+
+def test_inserting_a_duplicate_key_is_a_validation_error(ckan):
+    resource_id = create_table(ckan)
+    record = {'contest_name': 'Mayor', 'choice_name': 'A', 'votes': 1}
+    ckan.action.datastore_upsert(resource_id=resource_id, method='insert', force=True, records=[record])
+    with pytest.raises(ckanapi.ValidationError):
+        ckan.action.datastore_upsert(resource_id=resource_id, method='insert', force=True, records=[record])
+
+def test_search_filters_sort_and_fields(ckan):
+    resource_id = create_table(ckan)
+    ckan.action.datastore_upsert(resource_id=resource_id, method='upsert', force=True, records=[
+        {'contest_name': 'Mayor', 'choice_name': 'A', 'votes': 5},
+        {'contest_name': 'Mayor', 'choice_name': 'B', 'votes': 9},
+        {'contest_name': 'Council', 'choice_name': 'C', 'votes': 7}])
+    result = ckan.action.datastore_search(resource_id=resource_id, filters={'contest_name': 'Mayor'}, sort='votes desc', fields='choice_name,votes')
+    assert result['total'] == 2
+    assert result['records'] == [{'choice_name': 'B', 'votes': 9}, {'choice_name': 'A', 'votes': 5}]
+    assert ckan.action.datastore_search(resource_id=resource_id, q='Counc')['total'] == 1
+    with pytest.raises(ckanapi.ValidationError):
+        ckan.action.datastore_search(resource_id=resource_id, fields='choice_name,bogus')
+    with pytest.raises(ckanapi.ValidationError):
+        ckan.action.datastore_search(resource_id=resource_id, filters={'bogus': 1})
+
+def test_full_text_search_of_a_table_without_text_columns(ckan):
+    resource = ckan.action.resource_create(package_id='election-results', name='Counts', url='dummy-value')
+    ckan.action.datastore_create(resource_id=resource['id'], fields=[{'id': 'votes', 'type': 'int'}], records=[{'votes': 3}])
+    result = ckan.action.datastore_search(resource_id=resource['id'], q='3')
+    assert result['total'] == 0 and result['records'] == []
+
+def test_multipart_upload(ckan, tmp_path):
+    upload = tmp_path / 'detailxml.zip'
+    upload.write_bytes(b'PK\x03\x04 first')
+    with open(str(upload), 'rb') as f:
+        resource = ckan.action.resource_create(package_id='election-results', name='XML', url='dummy-value', upload=f)
+    assert resource['url_type'] == 'upload'
+    assert requests.get(resource['url']).content == b'PK\x03\x04 first'
+    upload.write_bytes(b'PK\x03\x04 second')
+    with open(str(upload), 'rb') as f:
+        resource = ckan.action.resource_update(id=resource['id'], package_id='election-results', url='dummy-value', upload=f)
+    assert requests.get(resource['url']).content == b'PK\x03\x04 second'
+    assert [r['name'] for r in ckan.action.package_show(id='election-results')['resources']] == ['XML']
+
+def test_delete_with_filters(ckan):
+    resource_id = create_table(ckan)
+    ckan.action.datastore_upsert(resource_id=resource_id, method='upsert', force=True, records=[
+        {'contest_name': 'Mayor', 'choice_name': 'A', 'votes': 5},
+        {'contest_name': 'Mayor', 'choice_name': 'Write-in', 'votes': 1}])
+    ckan.action.datastore_delete(resource_id=resource_id, filters={'contest_name': 'Mayor', 'choice_name': 'Write-in'}, force=True)
+    assert [r['choice_name'] for r in ckan.action.datastore_search(resource_id=resource_id)['records']] == ['A']
+    with pytest.raises(ckanapi.ValidationError):
+        ckan.action.datastore_delete(resource_id=resource_id, filters={'bogus': 1}, force=True)
+    # With no filters, the whole table goes.
+    ckan.action.datastore_delete(resource_id=resource_id, force=True)
+    with pytest.raises(ckanapi.NotFound):
+        ckan.action.datastore_search(resource_id=resource_id)
@@ -0,0 +1,50 @@
+import threading, time
+
+from locking import acquire_run_lock, release_run_lock
+
+def test_a_second_run_exits_while_the_lock_is_held(tmp_path):
+    lock = acquire_run_lock(str(tmp_path), 'test', 'General Election')
+    assert lock is not None
+    assert acquire_run_lock(str(tmp_path), 'test', 'General Election') is None
+    # Other servers and elections have their own locks.
+    other = acquire_run_lock(str(tmp_path), 'production', 'General Election')
+    assert other is not None
+    release_run_lock(other, 'published')
+    release_run_lock(lock, 'published')
+    lock = acquire_run_lock(str(tmp_path), 'test', 'General Election')
+    assert lock is not None
+    release_run_lock(lock, 'unchanged')
+
+def test_waiting_gives_up_after_the_timeout(tmp_path):
+    lock = acquire_run_lock(str(tmp_path), 'test', 'General Election')
+    start = time.time()
+    assert acquire_run_lock(str(tmp_path), 'test', 'General Election', {'wait': True, 'wait_timeout': 0.5}) is None
+    assert time.time() - start < 3
+    release_run_lock(lock, 'published')
+
+def release_later(lock, outcome, delay=0.3):
+    thread = threading.Thread(target=lambda: (time.sleep(delay), release_run_lock(lock, outcome)))
+    thread.start()
+    return thread
+
+def test_a_waiting_run_reuses_a_successful_result(tmp_path):
+    lock = acquire_run_lock(str(tmp_path), 'test', 'General Election')
+    thread = release_later(lock, 'published')
+    assert acquire_run_lock(str(tmp_path), 'test', 'General Election', {'wait': True, 'wait_timeout': 10}) is None
+    thread.join()
+
+def test_a_waiting_run_goes_ahead_after_a_failure(tmp_path):
+    lock = acquire_run_lock(str(tmp_path), 'test', 'General Election')
+    thread = release_later(lock, 'failed')
+    second = acquire_run_lock(str(tmp_path), 'test', 'General Election', {'wait': True, 'wait_timeout': 10})
+    thread.join()
+    assert second is not None
+    release_run_lock(second, 'published')
+
+def test_a_waiting_run_goes_ahead_after_a_run_without_an_outcome(tmp_path):
+    lock = acquire_run_lock(str(tmp_path), 'test', 'General Election')
+    thread = release_later(lock, None) # as prepare does
+    second = acquire_run_lock(str(tmp_path), 'test', 'General Election', {'wait': True, 'wait_timeout': 10})
+    thread.join()
+    assert second is not None
+    release_run_lock(second, 'published')
@@ -0,0 +1,56 @@
+import precinct_deltas
+from precinct_deltas import PrecinctSnapshot, diff_snapshots, publish_precinct_deltas, save_snapshot, snapshot_path
+
+def snapshot(rows):
+    s = PrecinctSnapshot()
+    for row in rows:
+        s.append(*row)
+    return s
+
+def test_everything_is_new_without_a_previous_snapshot():
+    current = snapshot([('Mayor', 'A', 'DEM', 'Election Day', 'P1', 5)])
+    changed, removed = diff_snapshots(None, current)
+    assert [(r['precinct_name'], r['votes'], r['previous_votes']) for r in changed] == [('P1', 5, None)]
+    assert removed == []
+
+def test_changed_new_and_removed_rows():
+    previous = snapshot([
+        ('Mayor', 'A', 'DEM', 'Election Day', 'P1', 5),
+        ('Mayor', 'Write-in', None, 'Election Day', 'P1', 1),
+        ('Mayor', 'A', 'DEM', 'Election Day', 'P2', 0),
+        ])
+    # Interned in a different order, so the two snapshots' string codes differ.
+    current = snapshot([
+        ('Council', 'X', 'REP', 'Mail-in', 'P9', 2),
+        ('Mayor', 'A', 'DEM', 'Election Day', 'P2', 3),
+        ('Mayor', 'A', 'DEM', 'Election Day', 'P1', 5),
+        ])
+    changed, removed = diff_snapshots(previous, current)
+    assert [(r['contest_name'], r['precinct_name'], r['votes'], r['previous_votes']) for r in changed] == [
+        ('Council', 'P9', 2, None), ('Mayor', 'P2', 3, 0)]
+    assert [(r['choice_name'], r['precinct_name'], r['party_name']) for r in removed] == [('Write-in', 'P1', None)]
+
+def test_unchanged_snapshots_have_no_differences(tmp_path):
+    rows = [('Mayor', 'A', 'DEM', 'Election Day', 'P{}'.format(k), k) for k in range(20)]
+    snapshot(rows).save(str(tmp_path / 'p.snapshot'))
+    previous = PrecinctSnapshot.load(str(tmp_path / 'p.snapshot'))
+    assert diff_snapshots(previous, snapshot(rows)) == ([], [])
+
+def test_removals_count_and_the_caller_saves_the_snapshot(tmp_path, monkeypatch):
+    previous = snapshot([('Mayor', 'A', 'DEM', 'Election Day', 'P1', 5), ('Mayor', 'Write-in', None, 'Election Day', 'P1', 1)])
+    current = snapshot([('Mayor', 'A', 'DEM', 'Election Day', 'P1', 5)])
+    snapshot_dir, output_dir = str(tmp_path / 'tmp'), str(tmp_path / 'public')
+    save_snapshot(previous, snapshot_dir, 'test', 'General Election')
+    deleted = []
+    monkeypatch.setattr(precinct_deltas, 'read_snapshot', lambda xml_zip: current)
+    monkeypatch.setattr(precinct_deltas, 'upsert_records', lambda *args, **kwargs: None)
+    monkeypatch.setattr(precinct_deltas, 'delete_records', lambda site, package_id, name, records, *args, **kwargs: deleted.extend(records))
+    monkeypatch.setattr(precinct_deltas, 'upload_file', lambda *args, **kwargs: None)
+
+    count, new_snapshot = publish_precinct_deltas('site', 'package', None, 'test', 'General Election', 'detailxml.zip', snapshot_dir, output_dir)
+    assert count == 1
+    assert [r['choice_name'] for r in deleted] == ['Write-in']
+    # Until the caller saves it, the previous snapshot is still the last published one.
+    assert len(PrecinctSnapshot.load(snapshot_path(snapshot_dir, 'test', 'General Election'))) == 2
+    save_snapshot(new_snapshot, snapshot_dir, 'test', 'General Election')
+    assert publish_precinct_deltas('site', 'package', None, 'test', 'General Election', 'detailxml.zip', snapshot_dir, output_dir) == (0, None)
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+from publishing import find_resource_id, create_resource, create_datastore
+from aggregates import aggregate_fields, aggregate_resource_name
+from precinct_deltas import precinct_fields, precinct_key, newly_reporting_fields, precinct_resource_names
+from columnar import export_resource_names
+
+# Pre-election warm-up.
+#
+# The County's results page is ready about two weeks before an election,
+# so everything that doesn't depend on the results themselves can be done
+# ahead of time: creating the results resource (with its datastore table),
+# the zipped XML resource, and the derived resources (the per-contest and
+# per-precinct tables, the JSON feeds and the columnar exports). Their
+# resource IDs are cached in the server's hash database, so that on
+# election night the ETL can upsert by resource ID without looking
+# anything up.
+#
+# If a prepared resource is deleted from CKAN, run prepare again.
+
+def prepared_resource_ids(db, r_name):
+    # Returns a dict mapping resource names to the IDs cached for the election.
+    return {entry['resource_name']: entry['resource_id'] for entry in db['prepared_resources'].find(election=r_name)}
+
+def save_prepared_resource(db, r_name, resource_name, resource_id):
+    db['prepared_resources'].upsert(dict(election=r_name, resource_name=resource_name, resource_id=resource_id,
+        prepared=datetime.now().strftime("%Y-%m-%d %H:%M:%S")), ['election', 'resource_name'])
+
+def find_or_create(site, package_id, API_key, resource_name, fields=None, primary_key=None):
+    resource_id = find_resource_id(site, package_id, resource_name, API_key=API_key)
+    if resource_id is not None:
+        print("The resource {} ({}) already exists.".format(resource_name, resource_id))
+    elif fields is not None:
+        resource_id = create_datastore(site, package_id, resource_name, fields, primary_key, API_key=API_key)
+        print("Created the resource {} ({}) with an empty datastore table.".format(resource_name, resource_id))
+    else:
+        resource_id = create_resource(site, package_id, resource_name, API_key=API_key)
+        print("Created the resource {} ({}).".format(resource_name, resource_id))
+    return resource_id
+
+def prepare_resources(site, package_id, API_key, db, r_name, fields, primary_key, xml_name, arrow=False):
+    # Finds or creates every resource that a cycle publishes to, caches
+    # their IDs and returns them.
+    precinct_name, newly_reporting_name, feed_name = precinct_resource_names(r_name)
+    datastores = [
+        (r_name, fields, primary_key),
+        (aggregate_resource_name(r_name), aggregate_fields, ['contest_name']),
+        (precinct_name, precinct_fields, precinct_key),
+        (newly_reporting_name, newly_reporting_fields, ['precinct_name']),
+        ]
+    files = [xml_name, aggregate_resource_name(r_name) + ' (JSON)', feed_name] + export_resource_names(r_name, arrow)
+    for resource_name, resource_fields, resource_key in datastores:
+        save_prepared_resource(db, r_name, resource_name, find_or_create(site, package_id, API_key, resource_name, resource_fields, resource_key))
+    for resource_name in files:
+        save_prepared_resource(db, r_name, resource_name, find_or_create(site, package_id, API_key, resource_name))
+    return prepared_resource_ids(db, r_name)